@@ -166,6 +166,22 @@ export class MapaAppStack extends cdk.Stack {
 
 		new CfnOutput(this, 'DailyBackupRule', { value: dailyBackupRule.ruleArn });
 
+		// Does nothing unless HISTORY_COMPACTION_AGE_DAYS or HISTORY_RETENTION_DAYS are set (see compact_feature_history)
+		const weeklyHistoryCompactionRule = new events.Rule(this, 'sundayHistoryCompactionRule', {
+			schedule: events.Schedule.cron({ minute: '0', hour: '2', weekDay: 'SUN' }), // 2AM UTC Sunday / 10AM AWST
+			targets: [
+				new eventTargets.LambdaFunction(djangoCronLambda, {
+					event: events.RuleTargetInput.fromObject({
+						event_type: 'compact_history',
+					}),
+				}),
+			],
+		});
+
+		eventTargets.addLambdaPermission(weeklyHistoryCompactionRule, djangoCronLambda);
+
+		new CfnOutput(this, 'WeeklyHistoryCompactionRule', { value: weeklyHistoryCompactionRule.ruleArn });
+
 		const managementEventsRule = new events.Rule(this, 'managementEventsRule', {
 			eventPattern: {
 				source: ['mapa'],
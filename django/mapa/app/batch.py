@@ -0,0 +1,234 @@
+from datetime import datetime
+
+import pytz
+from mapa.app.exceptions import BadRequest
+from mapa.app.models import Features, ReplayedFeatureMutations
+from mapa.app.payloads import serialize_features
+from mapa.app.serializers import FeatureSerializer
+from mapa.app.sync import bump_features_version
+from rest_framework.exceptions import ValidationError
+from simple_history.utils import (bulk_create_with_history,
+                                  bulk_update_with_history)
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+
+def _is_feature_id(value):
+    # JSON's true and false come through as bools, which Python counts as ints (and equal to 1 and 0)
+    return isinstance(value, int) is True and isinstance(value, bool) is False
+
+
+def apply_feature_operations(user, operations, importJobs=None):
+    """
+    Apply a list of feature operations in one transaction, with all of the
+    inserts, updates and history rows written in bulk.
+
+    Each operation is one of:
+        {"op": "create", "data": {...}}
+        {"op": "update", "id": 1, "data": {...}}  (only the fields given are changed)
+        {"op": "delete", "id": 1}  (a soft delete, as with FeaturesViewSet)
+
+    Operations are validated just as FeaturesViewSet would, and if any of them
+    are invalid nothing is applied. Returns the created and updated features
+    (in the order they were given), the ids of those that were deleted, and
+    the id of the feature each operation applied to.
+
+    importJobs optionally tags the features created by some operations
+    (by their index) with an import_job.
+    """
+    if importJobs is None:
+        importJobs = {}
+
+    if isinstance(operations, list) is False or len(operations) == 0:
+        raise BadRequest("Expected a list of operations")
+
+    if len(operations) > settings.FEATURES_BATCH_MAX_OPERATIONS:
+        raise BadRequest(f"Batches are limited to {settings.FEATURES_BATCH_MAX_OPERATIONS} operations")
+
+    featureIds = [operation.get("id") for operation in operations if isinstance(operation, dict) is True and operation.get("op") in ("update", "delete")]
+    features = Features.objects.filter(deleted_at=None, owner_id=user.id).in_bulk([id for id in featureIds if _is_feature_id(id) is True])
+
+    now = datetime.now(pytz.utc)
+    created = []
+    changed = {}
+    # Every feature created or updated, in the order they were given
+    results = []
+    # The feature each operation applied to
+    operationFeatures = []
+    # bulk_update() bypasses auto_now, so we stamp last_updated_date ourselves
+    changedFields = {"last_updated_date"}
+    mapIds = set()
+    errors = {}
+
+    for index, operation in enumerate(operations):
+        kind = operation.get("op") if isinstance(operation, dict) is True else None
+
+        if kind == "create":
+            serializer = FeatureSerializer(data=operation.get("data"))
+            if serializer.is_valid() is False:
+                errors[index] = serializer.errors
+            elif serializer.validated_data["map_id"].owner_id_id != user.id:
+                errors[index] = {"map_id": ["You don't own this map."]}
+            else:
+                # bulk_create() bypasses Features.save(), so we set the owner from the map ourselves
+                feature = Features(**serializer.validated_data, owner_id_id=serializer.validated_data["map_id"].owner_id_id, import_job=importJobs.get(index, ""))
+                created.append(feature)
+                results.append(feature)
+                operationFeatures.append(feature)
+
+        elif kind in ("update", "delete"):
+            feature = features.get(operation.get("id")) if _is_feature_id(operation.get("id")) is True else None
+            if feature is None:
+                errors[index] = {"id": ["Feature not found."]}
+                continue
+
+            # Features can be moved between maps, in which case both maps have changed
+            mapIds.add(feature.map_id_id)
+
+            if kind == "update":
+                serializer = FeatureSerializer(feature, data=operation.get("data"), partial=True)
+                if serializer.is_valid() is False:
+                    errors[index] = serializer.errors
+                    continue
+                elif "map_id" in serializer.validated_data and serializer.validated_data["map_id"].owner_id_id != user.id:
+                    errors[index] = {"map_id": ["You don't own this map."]}
+                    continue
+
+                for field, value in serializer.validated_data.items():
+                    setattr(feature, field, value)
+                # Only the fields whose values actually changed, so e.g. moving features doesn't rewrite their data
+                changedFields.update(feature.get_changed_fields())
+                results.append(feature)
+            else:
+                feature.deleted_at = now
+                changedFields.add("deleted_at")
+
+            feature.last_updated_date = now
+            changed[feature.id] = feature
+            operationFeatures.append(feature)
+
+        else:
+            errors[index] = {"op": [f"Unknown operation '{kind}'."]}
+
+    if len(errors) > 0:
+        raise ValidationError(errors)
+
+    with transaction.atomic():
+        if len(created) > 0:
+            bulk_create_with_history(created, Features, default_user=user)
+        if len(changed) > 0:
+            bulk_update_with_history(list(changed.values()), Features, fields=sorted(changedFields), default_user=user)
+
+        mapIds.update(feature.map_id_id for feature in created + list(changed.values()))
+        bump_features_version(mapIds)
+
+    liveIds = list(dict.fromkeys(feature.id for feature in results if feature.deleted_at is None))
+    featuresById = {feature["id"]: feature for feature in serialize_features(Features.objects.filter(id__in=liveIds))}
+
+    return {
+        "features": [featuresById[id] for id in liveIds],
+        "deleted_ids": [feature.id for feature in changed.values() if feature.deleted_at is not None],
+        "ids": [feature.id for feature in operationFeatures],
+    }
+
+
+def replay_feature_mutations(user, mutations):
+    """
+    Apply the mutations a client queued up while it was offline, skipping any
+    we've already applied, so the client can safely retry until it hears back.
+
+    Each mutation is an operation (as for apply_feature_operations) plus a
+    unique "key" generated by the client. Features created offline have no
+    id yet, so later mutations can refer to them by the key of the mutation
+    that created them instead: {"op": "update", "ref": "<key>", "data": {...}}
+
+    Created features are tagged with an import_job of "offline:<key>".
+
+    Deleting a feature that's already gone (e.g. because another device deleted
+    it first) counts as applied. Mutations that can't be applied (e.g. updates to
+    a feature that's been deleted, or invalid data) are reported back as conflicts
+    rather than holding up the rest of the queue, and the client should drop them.
+    """
+    if isinstance(mutations, list) is False or len(mutations) == 0:
+        raise BadRequest("Expected a list of mutations")
+
+    if all(isinstance(mutation, dict) is True and isinstance(mutation.get("key"), str) is True and mutation["key"] != "" for mutation in mutations) is False:
+        raise BadRequest("Every mutation needs a key")
+
+    keys = [mutation["key"] for mutation in mutations]
+    if len(set(keys)) != len(keys):
+        raise BadRequest("Mutation keys must be unique")
+
+    try:
+        return _replay_feature_mutations(user, mutations)
+    except IntegrityError:
+        # Another request (most likely an earlier attempt at this same replay) applied some of these first
+        return _replay_feature_mutations(user, mutations)
+
+
+def _replay_feature_mutations(user, mutations):
+    applied = dict(ReplayedFeatureMutations.objects.filter(owner_id=user.id, key__in=[mutation["key"] for mutation in mutations]).values_list("key", "feature_id"))
+    pending = [mutation for mutation in mutations if mutation["key"] not in applied]
+
+    # Mutations of features created in this replay have to wait until they exist. Everything
+    # else can go first, which keeps the mutations of each feature in the order they were made.
+    createKeys = {mutation["key"] for mutation in pending if mutation.get("op") == "create"}
+    phases = [
+        [mutation for mutation in pending if mutation.get("ref") not in createKeys],
+        [mutation for mutation in pending if mutation.get("ref") in createKeys],
+    ]
+
+    featureIds = dict(applied)
+    features = {}
+    deletedIds = []
+    conflicts = {}
+    # The keys of the mutations we've applied (or that turned out to need no applying)
+    doneKeys = set()
+
+    with transaction.atomic():
+        for phase in phases:
+            targetIds = {mutation["key"]: featureIds.get(mutation["ref"]) if "ref" in mutation else mutation.get("id") for mutation in phase}
+            liveIds = set(Features.objects.filter(deleted_at=None, owner_id=user.id, id__in=[id for id in targetIds.values() if _is_feature_id(id) is True]).values_list("id", flat=True))
+
+            # Deleting a feature that's already gone needs no doing
+            for mutation in phase:
+                if mutation.get("op") == "delete" and (_is_feature_id(targetIds[mutation["key"]]) is False or targetIds[mutation["key"]] not in liveIds):
+                    featureIds[mutation["key"]] = targetIds[mutation["key"]] if _is_feature_id(targetIds[mutation["key"]]) is True else None
+                    doneKeys.add(mutation["key"])
+            phase = [mutation for mutation in phase if mutation["key"] not in doneKeys]
+
+            # Set aside the mutations that can't be applied, and apply the rest
+            while len(phase) > 0:
+                operations = [{
+                    "op": mutation.get("op"),
+                    "id": targetIds[mutation["key"]],
+                    "data": mutation.get("data"),
+                } for mutation in phase]
+
+                try:
+                    result = apply_feature_operations(user, operations, importJobs={index: f"offline:{mutation['key']}" for index, mutation in enumerate(phase)})
+                except ValidationError as e:
+                    conflicts.update((phase[index]["key"], detail) for index, detail in e.detail.items())
+                    phase = [mutation for index, mutation in enumerate(phase) if index not in e.detail]
+                    continue
+
+                for mutation, featureId in zip(phase, result["ids"]):
+                    featureIds[mutation["key"]] = featureId
+                    doneKeys.add(mutation["key"])
+                features.update((feature["id"], feature) for feature in result["features"])
+                deletedIds += result["deleted_ids"]
+                break
+
+        ReplayedFeatureMutations.objects.bulk_create([
+            ReplayedFeatureMutations(owner_id=user, key=mutation["key"], op=mutation.get("op"), feature_id=featureIds[mutation["key"]])
+            for mutation in pending if mutation["key"] in doneKeys
+        ])
+
+    return {
+        "features": [feature for id, feature in features.items() if id not in deletedIds],
+        "deleted_ids": deletedIds,
+        "ids": {mutation["key"]: featureIds.get(mutation["key"]) for mutation in mutations},
+        "duplicate_keys": [mutation["key"] for mutation in mutations if mutation["key"] in applied],
+        "conflicts": conflicts,
+    }
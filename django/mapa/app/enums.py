@@ -21,3 +21,12 @@ class GeomType(str, EnumBase):
 
     def __str__(self):
         return self.value
+
+
+class SchemaUsageKind(str, EnumBase):
+    SCHEMA = "schema"
+    SYMBOL = "symbol"
+    FIELD = "field"
+
+    def __str__(self):
+        return self.value
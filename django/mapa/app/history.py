@@ -0,0 +1,469 @@
+import traceback
+from contextlib import contextmanager
+from copy import deepcopy
+from datetime import datetime, timedelta
+from functools import partial
+
+import pytz
+from asgiref.local import Local
+from mapa.util import threaded
+from simple_history.models import HistoricalRecords
+from simple_history.signals import (post_create_historical_record,
+                                    pre_create_historical_record)
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.db import connection, transaction
+from django.utils import timezone
+
+_state = Local()
+
+
+class DeferredHistoricalRecords(HistoricalRecords):
+    """
+    HistoricalRecords that can take writing history rows out of each save()
+    (see settings.HISTORY_WRITE_MODE).
+
+    In "deferred" mode each history row is built when its instance is saved, so it
+    records the instance exactly as it was then, but is only queued to be written
+    once the change it records has been committed. Everything queued during a
+    request is then written in one bulk_create per history model when the request
+    finishes (see DeferredHistoryMiddleware). Changes that are rolled back never
+    make it into the queue.
+
+    In "background" mode the queued rows are handed to a thread to write, which
+    takes even the bulk insert out of the request. Lambda may freeze that thread
+    along with everything else once it has responded, so this suits long
+    running servers best.
+
+    Saves made outside of a request (e.g. by management events) are recorded
+    as they happen, as usual.
+
+    pre_create_historical_record is sent as each row is built (so receivers can
+    still change it) and post_create_historical_record once it's been written.
+    """
+
+    def create_historical_record(self, instance, history_type, using=None):
+        if is_deferring_history() is False:
+            return super().create_historical_record(instance, history_type, using=using)
+
+        # Built just as HistoricalRecords.create_historical_record does, bar the deepcopy
+        using = using if self.use_base_model_db else None
+        history_date = getattr(instance, "_history_date", timezone.now())
+        history_user = self.get_history_user(instance)
+        history_change_reason = self.get_change_reason_for_object(instance, history_type, using)
+        manager = getattr(instance, self.manager_name)
+
+        # The instance (and its JSON fields) may well change again before we write this
+        attrs = {field.attname: deepcopy(getattr(instance, field.attname)) for field in self.fields_included(instance)}
+
+        if getattr(manager.model, "history_relation", None) is not None:
+            attrs["history_relation"] = instance
+
+        history_instance = manager.model(
+            history_date=history_date,
+            history_type=history_type,
+            history_user=history_user,
+            history_change_reason=history_change_reason,
+            **attrs,
+        )
+
+        pre_create_historical_record.send(
+            sender=manager.model,
+            instance=instance,
+            history_date=history_date,
+            history_user=history_user,
+            history_change_reason=history_change_reason,
+            history_instance=history_instance,
+            using=using,
+        )
+
+        def on_written():
+            self.create_historical_record_m2ms(history_instance, instance)
+
+            post_create_historical_record.send(
+                sender=manager.model,
+                instance=instance,
+                history_instance=history_instance,
+                history_date=history_date,
+                history_user=history_user,
+                history_change_reason=history_change_reason,
+                using=using,
+            )
+
+        queue_history_record(history_instance, using=using, on_written=on_written)
+
+
+def is_deferring_history():
+    return settings.HISTORY_WRITE_MODE != "immediate" and getattr(_state, "records", None) is not None
+
+
+def queue_history_record(record, using=None, on_written=None):
+    """
+    Queue a history row to be written at the end of the request, once the change it records is committed.
+
+    on_written (if given) is called once the row has been written.
+    """
+    # on_commit() runs this straight away outside of a transaction, and never if it's rolled back
+    transaction.on_commit(partial(_state.records.append, (record, using, on_written)))
+
+
+def save_history_record(record):
+    """
+    Write (or queue, if we're deferring history) a history row we've built ourselves.
+    """
+    if is_deferring_history() is True:
+        queue_history_record(record)
+    else:
+        record.save()
+
+
+class DeltaHistoricalRecords(DeferredHistoricalRecords):
+    """
+    DeferredHistoricalRecords that, when settings.FEATURE_HISTORY_STORAGE is "delta",
+    stores most updates as a compact delta from the feature's previous state
+    (see build_feature_delta) rather than as a full copy of the row.
+
+    Every settings.FEATURE_HISTORY_SNAPSHOT_INTERVAL changes (and on creation,
+    deletion, restoration and moving to another map) a full snapshot is written to the history table as usual, so
+    rebuilding a feature as it was at any point (see get_feature_as_of) only
+    ever needs one snapshot plus the deltas since.
+
+    The model needs a FieldTracker, which is what tells us what has changed.
+
+    Only snapshots are in the history table, so the history/ endpoint isn't
+    available for features stored this way (see FeaturesViewSet.history).
+    """
+
+    def create_historical_record(self, instance, history_type, using=None):
+        from mapa.app.models import FeatureHistoryDeltas
+
+        if settings.FEATURE_HISTORY_STORAGE == "delta" and history_type == "~" and self.is_snapshot_due(instance) is False:
+            save_history_record(FeatureHistoryDeltas(
+                feature_id=instance.pk,
+                history_date=getattr(instance, "_history_date", timezone.now()),
+                history_user=self.get_history_user(instance),
+                changes=build_feature_delta(instance),
+            ))
+            return
+
+        return super().create_historical_record(instance, history_type, using=using)
+
+    def is_snapshot_due(self, instance):
+        from mapa.app.models import FeatureHistoryDeltas
+
+        # Deleting a feature is a save like any other in this app, but is worth a snapshot to find it by.
+        # Delta syncs also find the features that have moved off of a map from the history table (see sync.get_features_delta).
+        changed = instance.tracker.changed()
+        if "deleted_at" in changed or "map_id_id" in changed:
+            return True
+
+        lastSnapshotDate = getattr(instance, self.manager_name).order_by("-history_date").values_list("history_date", flat=True).first()
+        if lastSnapshotDate is None:
+            return True
+
+        deltaCount = FeatureHistoryDeltas.objects.filter(feature_id=instance.pk, history_date__gt=lastSnapshotDate).count()
+        return deltaCount >= settings.FEATURE_HISTORY_SNAPSHOT_INTERVAL - 1
+
+
+def get_concrete_fields_by_attname(model):
+    return {field.attname: field for field in model._meta.concrete_fields}
+
+
+def build_feature_delta(instance):
+    """
+    Describe how a feature has changed since it was loaded (or last saved):
+
+        geom_offset  How far the point moved, as [dx, dy]
+        geom         The new coordinates as [x, y], when an offset can't reproduce them exactly
+        data         A patch to the previous data (see diff_feature_data)
+        ...          The new value of any other column that changed
+    """
+    fields = get_concrete_fields_by_attname(type(instance))
+    changes = {}
+
+    for attname, previous in instance.tracker.changed().items():
+        current = getattr(instance, attname)
+
+        if attname == "geom":
+            if previous is not None and current is not None:
+                offset = [current.x - previous.x, current.y - previous.y]
+                if previous.x + offset[0] == current.x and previous.y + offset[1] == current.y:
+                    changes["geom_offset"] = offset
+                    continue
+
+            changes["geom"] = [current.x, current.y] if current is not None else None
+        elif attname == "data":
+            changes["data"] = diff_feature_data(previous, current)
+        else:
+            changes[attname] = fields[attname].value_from_object(instance)
+
+    return changes
+
+
+def diff_feature_data(previous, current):
+    """
+    Build a patch that turns one version of a feature's data into another:
+    {"set": {<schema_field_id>: <value>}, "remove": [<schema_field_id>]}
+
+    Data that doesn't look like our usual [{"schema_field_id": ..., "value": ...}]
+    list (or that the patch can't exactly reproduce) is stored in full as {"replace": <data>}.
+    """
+    if is_feature_data(previous) is True and is_feature_data(current) is True:
+        previousValues = {str(item["schema_field_id"]): item["value"] for item in previous}
+        currentValues = {str(item["schema_field_id"]): item["value"] for item in current}
+
+        patch = {
+            # Checking the type too, as True == 1 (but they're different values in JSON)
+            "set": {id: value for id, value in currentValues.items() if id not in previousValues or previousValues[id] != value or type(previousValues[id]) is not type(value)},
+            "remove": [id for id in previousValues if id not in currentValues],
+        }
+
+        if apply_feature_data_patch(previous, patch) == current:
+            return patch
+
+    return {"replace": deepcopy(current)}
+
+
+def is_feature_data(data):
+    return isinstance(data, list) is True and all(isinstance(item, dict) is True and set(item.keys()) == {"schema_field_id", "value"} for item in data)
+
+
+def apply_feature_data_patch(data, patch):
+    if "replace" in patch:
+        return deepcopy(patch["replace"])
+
+    values = dict(patch["set"])
+    patched = []
+    for item in data:
+        id = str(item["schema_field_id"])
+        if id not in patch["remove"]:
+            patched.append({"schema_field_id": item["schema_field_id"], "value": deepcopy(values.pop(id)) if id in values else deepcopy(item["value"])})
+
+    # Fields given a value for the first time go on the end
+    patched += [{"schema_field_id": int(id), "value": deepcopy(value)} for id, value in values.items()]
+
+    return patched
+
+
+def apply_feature_delta(feature, changes):
+    fields = get_concrete_fields_by_attname(type(feature))
+
+    for attname, value in changes.items():
+        if attname == "geom_offset":
+            feature.geom = Point(feature.geom.x + value[0], feature.geom.y + value[1], srid=feature.geom.srid)
+        elif attname == "geom":
+            feature.geom = Point(value[0], value[1], srid=4326) if value is not None else None
+        elif attname == "data":
+            feature.data = apply_feature_data_patch(feature.data, value)
+        else:
+            setattr(feature, attname, fields[attname].to_python(value) if value is not None else None)
+
+
+def get_feature_as_of(featureId, when):
+    """
+    Rebuild a feature as it was at a point in time from its latest snapshot
+    before then plus the deltas since. Returns an (unsaved) Features instance,
+    or None if the feature didn't exist yet (or had been permanently deleted).
+    """
+    from mapa.app.models import FeatureHistoryDeltas, Features
+
+    snapshot = Features.history.filter(id=featureId, history_date__lte=when).order_by("-history_date", "-history_id").first()
+    if snapshot is None or snapshot.history_type == "-":
+        return None
+
+    feature = snapshot.instance
+    for changes in FeatureHistoryDeltas.objects.filter(feature_id=featureId, history_date__gt=snapshot.history_date, history_date__lte=when).order_by("history_date", "id").values_list("changes", flat=True):
+        apply_feature_delta(feature, changes)
+
+    return feature
+
+
+def write_history_records(records):
+    """
+    Write queued history rows in one bulk_create per history model (and database),
+    then let anything waiting on them know they've been written.
+    """
+    recordsByModel = {}
+    for record, using, on_written in records:
+        recordsByModel.setdefault((type(record), using), []).append(record)
+
+    for (model, using), modelRecords in recordsByModel.items():
+        model.objects.using(using).bulk_create(modelRecords)
+
+    for record, using, on_written in records:
+        if on_written is not None:
+            on_written()
+
+
+@threaded
+def write_history_records_in_background(records):
+    try:
+        write_history_records(records)
+    except Exception:
+        print("Failed to write deferred history rows in the background")
+        traceback.print_exc()
+    finally:
+        # Threads get their own database connection, which would otherwise be left open
+        connection.close()
+
+
+@contextmanager
+def deferring_history():
+    """
+    Queue up the history rows for everything saved inside this block, and
+    write them all in one go at the end of it.
+    """
+    _state.records = []
+
+    try:
+        yield
+    finally:
+        records, _state.records = _state.records, None
+
+        if len(records) > 0:
+            if settings.HISTORY_WRITE_MODE == "background":
+                write_history_records_in_background(records)
+            else:
+                try:
+                    write_history_records(records)
+                except Exception:
+                    # The changes these record have already been committed, so failing the
+                    # response (or hiding whatever the request itself raised) wouldn't undo them
+                    print("Failed to write deferred history rows")
+                    traceback.print_exc()
+
+
+class DeferredHistoryMiddleware:
+    """
+    Defers writing history rows until the end of each request (see DeferredHistoricalRecords).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if settings.HISTORY_WRITE_MODE == "immediate":
+            return self.get_response(request)
+
+        with deferring_history():
+            return self.get_response(request)
+
+
+# How compaction may group history rows
+HISTORY_COMPACTION_PERIODS = ("hour", "day", "week", "month")
+
+
+def compact_feature_history():
+    """
+    Keep the feature history table from growing without limit. This permanently
+    removes history, so it does nothing unless it's been configured:
+
+    1. Compaction: If settings.HISTORY_COMPACTION_AGE_DAYS is set, past that each feature's
+    updates are collapsed into one snapshot per settings.HISTORY_COMPACTION_PERIOD
+    (the last version of the feature in that period). Creations and deletions
+    are always kept.
+
+    2. Retention: If settings.HISTORY_RETENTION_DAYS is set, history older than
+    that is removed, except for the latest version of each feature.
+
+    Snapshots that deltas build on (see DeltaHistoricalRecords) are always kept,
+    as without them the deltas are meaningless. So is the latest row for each map
+    a feature has been on, which delta syncs use to find features that have
+    moved off of a map (see sync.get_features_delta).
+
+    The work is done one map at a time to keep each DELETE (and its locks) small.
+    Features are grouped by the map they're on now rather than the map each
+    history row was on, so the whole history of features that have moved
+    between maps is seen at once.
+    """
+    # Imported here as models.py imports this module for DeferredHistoricalRecords
+    from mapa.app.models import FeatureHistoryDeltas, Features, Maps
+
+    if settings.HISTORY_COMPACTION_AGE_DAYS is None and settings.HISTORY_RETENTION_DAYS is None:
+        print("Feature history compaction and retention aren't configured")
+        return {"compacted": 0, "expired": 0}
+
+    if settings.HISTORY_COMPACTION_PERIOD not in HISTORY_COMPACTION_PERIODS:
+        raise Exception(f"Unknown history compaction period '{settings.HISTORY_COMPACTION_PERIOD}'")
+
+    table = connection.ops.quote_name(Features.history.model._meta.db_table)
+    deltasTable = connection.ops.quote_name(FeatureHistoryDeltas._meta.db_table)
+    featuresTable = connection.ops.quote_name(Features._meta.db_table)
+    now = datetime.now(pytz.utc)
+    compactBefore = now - timedelta(days=settings.HISTORY_COMPACTION_AGE_DAYS) if settings.HISTORY_COMPACTION_AGE_DAYS is not None else None
+    retainAfter = now - timedelta(days=settings.HISTORY_RETENTION_DAYS) if settings.HISTORY_RETENTION_DAYS is not None else None
+
+    # Whether any deltas build on a snapshot, i.e. come after it and before the next one
+    hasDeltas = f"""
+        EXISTS (
+            SELECT 1 FROM {deltasTable} AS d
+            WHERE d.feature_id = snapshots.id
+                AND d.history_date > snapshots.history_date
+                AND (snapshots.next_history_date IS NULL OR d.history_date <= snapshots.next_history_date)
+        )
+    """
+
+    compacted = 0
+    expired = 0
+
+    for mapId in Maps.objects.order_by("id").values_list("id", flat=True):
+        with transaction.atomic(), connection.cursor() as cursor:
+            if compactBefore is not None:
+                cursor.execute(f"""
+                    DELETE FROM {table} AS h
+                    USING (
+                        SELECT
+                            history_id,
+                            id,
+                            history_type,
+                            history_date,
+                            row_number() OVER (PARTITION BY id, date_trunc(%(period)s, history_date) ORDER BY history_date DESC, history_id DESC) AS version,
+                            row_number() OVER (PARTITION BY id, map_id ORDER BY history_date DESC, history_id DESC) AS map_version,
+                            lead(history_date) OVER (PARTITION BY id ORDER BY history_date, history_id) AS next_history_date
+                        FROM {table}
+                        WHERE id IN (SELECT id FROM {featuresTable} WHERE map_id = %(map_id)s)
+                    ) AS snapshots
+                    WHERE h.history_id = snapshots.history_id
+                        AND snapshots.history_type = '~'
+                        AND snapshots.history_date < %(before)s
+                        AND snapshots.version > 1
+                        AND snapshots.map_version > 1
+                        AND NOT {hasDeltas}
+                """, {"map_id": mapId, "period": settings.HISTORY_COMPACTION_PERIOD, "before": compactBefore})
+                compacted += cursor.rowcount
+
+            if retainAfter is not None:
+                # Deltas followed by a snapshot are only needed to rebuild features as they were before it
+                cursor.execute(f"""
+                    DELETE FROM {deltasTable} AS d
+                    WHERE d.feature_id IN (SELECT id FROM {featuresTable} WHERE map_id = %(map_id)s)
+                        AND d.history_date < %(after)s
+                        AND EXISTS (SELECT 1 FROM {table} AS h WHERE h.id = d.feature_id AND h.history_date > d.history_date)
+                """, {"map_id": mapId, "after": retainAfter})
+                expired += cursor.rowcount
+
+                cursor.execute(f"""
+                    DELETE FROM {table} AS h
+                    USING (
+                        SELECT
+                            history_id,
+                            id,
+                            history_date,
+                            row_number() OVER (PARTITION BY id ORDER BY history_date DESC, history_id DESC) AS version,
+                            row_number() OVER (PARTITION BY id, map_id ORDER BY history_date DESC, history_id DESC) AS map_version,
+                            lead(history_date) OVER (PARTITION BY id ORDER BY history_date, history_id) AS next_history_date
+                        FROM {table}
+                        WHERE id IN (SELECT id FROM {featuresTable} WHERE map_id = %(map_id)s)
+                    ) AS snapshots
+                    WHERE h.history_id = snapshots.history_id
+                        AND snapshots.history_date < %(after)s
+                        AND snapshots.version > 1
+                        AND snapshots.map_version > 1
+                        AND NOT {hasDeltas}
+                """, {"map_id": mapId, "after": retainAfter})
+                expired += cursor.rowcount
+
+    print(f"Feature history compaction removed {compacted} rows and retention removed {expired} rows")
+
+    return {"compacted": compacted, "expired": expired}
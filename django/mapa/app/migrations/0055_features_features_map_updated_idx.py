@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0054_alter_profile_whats_new_release_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='features',
+            index=models.Index(fields=['map_id', 'last_updated_date'], name='features_map_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0055_features_features_map_updated_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='maps',
+            name='features_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
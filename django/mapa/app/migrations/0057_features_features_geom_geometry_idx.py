@@ -0,0 +1,20 @@
+# Generated by Django 5.2.7 on 2026-10-18 10:41
+
+import django.contrib.gis.db.models.fields
+import django.contrib.postgres.indexes
+import django.db.models.functions.comparison
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0056_maps_features_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='features',
+            index=django.contrib.postgres.indexes.GistIndex(django.db.models.functions.comparison.Cast('geom', django.contrib.gis.db.models.fields.PointField(srid=4326)), name='features_geom_geometry_idx'),
+        ),
+    ]
@@ -0,0 +1,95 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:20
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+# Features are searchable by the text values in their data (weighted B) and the
+# name of their symbol (weighted A). The 'simple' configuration doesn't stem or
+# drop stop words, which suits plant names (and the many languages they're in).
+# FeatureSerializer doesn't check the shape of data, so anything that isn't an array is treated as empty.
+CREATE_FEATURES_TRIGGER = """
+CREATE FUNCTION app_features_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('simple', COALESCE((
+            SELECT symbol -> 'props' ->> 'name'
+            FROM app_featureschemas AS s, jsonb_array_elements(s.symbology -> 'symbols') AS symbol
+            WHERE s.id = NEW.schema_id AND (symbol ->> 'id')::integer = NEW.symbol_id
+        ), '')), 'A') ||
+        setweight(to_tsvector('simple', COALESCE((
+            SELECT string_agg(item ->> 'value', ' ')
+            FROM jsonb_array_elements(CASE WHEN jsonb_typeof(NEW.data) = 'array' THEN NEW.data ELSE '[]' END) AS item
+            WHERE jsonb_typeof(item -> 'value') = 'string'
+        ), '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+-- search_vector is in the column list because full saves from Django write back whatever value they loaded
+CREATE TRIGGER app_features_search_vector_update
+    BEFORE INSERT OR UPDATE OF data, schema_id, symbol_id, search_vector ON app_features
+    FOR EACH ROW EXECUTE FUNCTION app_features_search_vector_update();
+"""
+
+# Renaming a symbol re-indexes just the features using it, by poking their symbol_id
+CREATE_FEATURE_SCHEMAS_TRIGGER = """
+CREATE FUNCTION app_featureschemas_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    UPDATE app_features SET symbol_id = symbol_id
+    WHERE schema_id = NEW.id AND symbol_id IN (
+        SELECT id
+        FROM (
+            SELECT (symbol ->> 'id')::integer AS id, symbol -> 'props' ->> 'name' AS name
+            FROM jsonb_array_elements(NEW.symbology -> 'symbols') AS symbol
+        ) AS new_symbols
+        FULL JOIN (
+            SELECT (symbol ->> 'id')::integer AS id, symbol -> 'props' ->> 'name' AS name
+            FROM jsonb_array_elements(OLD.symbology -> 'symbols') AS symbol
+        ) AS old_symbols USING (id)
+        WHERE new_symbols.name IS DISTINCT FROM old_symbols.name
+    );
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER app_featureschemas_search_vector_update
+    AFTER UPDATE OF symbology ON app_featureschemas
+    FOR EACH ROW WHEN (OLD.symbology IS DISTINCT FROM NEW.symbology)
+    EXECUTE FUNCTION app_featureschemas_search_vector_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0057_features_features_geom_geometry_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='features',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            CREATE_FEATURES_TRIGGER,
+            reverse_sql="""
+                DROP TRIGGER app_features_search_vector_update ON app_features;
+                DROP FUNCTION app_features_search_vector_update();
+            """,
+        ),
+        migrations.RunSQL(
+            CREATE_FEATURE_SCHEMAS_TRIGGER,
+            reverse_sql="""
+                DROP TRIGGER app_featureschemas_search_vector_update ON app_featureschemas;
+                DROP FUNCTION app_featureschemas_search_vector_update();
+            """,
+        ),
+        # Let the trigger index all of the existing features
+        migrations.RunSQL("UPDATE app_features SET search_vector = NULL", reverse_sql=migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='features',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='features_search_vector_idx'),
+        ),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 5.2.7 on 2026-10-18 11:45
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+# search_text is the same text as search_vector is built from, lower cased, for fuzzy searches
+CREATE_FEATURES_TRIGGER = """
+CREATE OR REPLACE FUNCTION app_features_search_vector_update() RETURNS trigger AS $$
+DECLARE
+    symbol_name text;
+    data_text text;
+BEGIN
+    SELECT symbol -> 'props' ->> 'name' INTO symbol_name
+    FROM app_featureschemas AS s, jsonb_array_elements(s.symbology -> 'symbols') AS symbol
+    WHERE s.id = NEW.schema_id AND (symbol ->> 'id')::integer = NEW.symbol_id;
+
+    SELECT string_agg(item ->> 'value', ' ') INTO data_text
+    FROM jsonb_array_elements(CASE WHEN jsonb_typeof(NEW.data) = 'array' THEN NEW.data ELSE '[]' END) AS item
+    WHERE jsonb_typeof(item -> 'value') = 'string';
+
+    NEW.search_vector := setweight(to_tsvector('simple', COALESCE(symbol_name, '')), 'A') || setweight(to_tsvector('simple', COALESCE(data_text, '')), 'B');
+    NEW.search_text := lower(concat_ws(' ', symbol_name, data_text));
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER app_features_search_vector_update ON app_features;
+
+CREATE TRIGGER app_features_search_vector_update
+    BEFORE INSERT OR UPDATE OF data, schema_id, symbol_id, search_vector, search_text ON app_features
+    FOR EACH ROW EXECUTE FUNCTION app_features_search_vector_update();
+"""
+
+REVERSE_FEATURES_TRIGGER = """
+CREATE OR REPLACE FUNCTION app_features_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('simple', COALESCE((
+            SELECT symbol -> 'props' ->> 'name'
+            FROM app_featureschemas AS s, jsonb_array_elements(s.symbology -> 'symbols') AS symbol
+            WHERE s.id = NEW.schema_id AND (symbol ->> 'id')::integer = NEW.symbol_id
+        ), '')), 'A') ||
+        setweight(to_tsvector('simple', COALESCE((
+            SELECT string_agg(item ->> 'value', ' ')
+            FROM jsonb_array_elements(CASE WHEN jsonb_typeof(NEW.data) = 'array' THEN NEW.data ELSE '[]' END) AS item
+            WHERE jsonb_typeof(item -> 'value') = 'string'
+        ), '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER app_features_search_vector_update ON app_features;
+
+CREATE TRIGGER app_features_search_vector_update
+    BEFORE INSERT OR UPDATE OF data, schema_id, symbol_id, search_vector ON app_features
+    FOR EACH ROW EXECUTE FUNCTION app_features_search_vector_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0058_features_search_vector'),
+    ]
+
+    operations = [
+        # In public, alongside PostGIS, so every environment's schema can use it (and it survives schemas being dropped and restored).
+        # Other schemas may be using it, so it's left in place on the way back.
+        migrations.RunSQL("CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public", reverse_sql=migrations.RunSQL.noop),
+        migrations.AddField(
+            model_name='features',
+            name='search_text',
+            field=models.TextField(editable=False, null=True),
+        ),
+        migrations.RunSQL(CREATE_FEATURES_TRIGGER, reverse_sql=REVERSE_FEATURES_TRIGGER),
+        # Let the trigger fill in search_text for all of the existing features
+        migrations.RunSQL("UPDATE app_features SET search_text = NULL", reverse_sql=migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='features',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_text'], name='features_search_text_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+    ]
@@ -0,0 +1,107 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:10
+
+import django.db.models.deletion
+import mapa.app.enums
+from django.db import migrations, models
+
+# The usage rows a feature counts towards: its schema, its symbol, and each field it has a value for.
+# Only live features with a schema count, as those are what the can_delete checks care about.
+# data isn't validated, so anything that isn't an array (or a field id that isn't a whole number) is ignored.
+CREATE_USAGE_TRIGGER = """
+CREATE FUNCTION app_featureschemausage_apply(feature app_features, delta integer) RETURNS void AS $$
+BEGIN
+    IF feature.deleted_at IS NOT NULL OR feature.schema_id IS NULL THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO app_featureschemausage (schema_id, map_id, kind, ref_id, count)
+    SELECT feature.schema_id, feature.map_id, usage.kind, usage.ref_id, delta
+    FROM (
+        SELECT 'schema' AS kind, 0 AS ref_id
+        UNION ALL
+        SELECT 'symbol', feature.symbol_id WHERE feature.symbol_id IS NOT NULL
+        UNION ALL
+        SELECT DISTINCT 'field', (item ->> 'schema_field_id')::integer FROM jsonb_array_elements(CASE WHEN jsonb_typeof(feature.data) = 'array' THEN feature.data ELSE '[]' END) AS item WHERE item ->> 'schema_field_id' ~ '^\\d+$'
+    ) AS usage
+    ON CONFLICT (schema_id, kind, ref_id, map_id) DO UPDATE SET count = app_featureschemausage.count + EXCLUDED.count;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION app_features_usage_update() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM app_featureschemausage_apply(OLD, -1);
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM app_featureschemausage_apply(NEW, 1);
+    END IF;
+
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER app_features_usage_insert_delete
+    AFTER INSERT OR DELETE ON app_features
+    FOR EACH ROW EXECUTE FUNCTION app_features_usage_update();
+
+-- Most updates just move a feature around, and don't change what it uses
+CREATE TRIGGER app_features_usage_update
+    AFTER UPDATE ON app_features
+    FOR EACH ROW WHEN (
+        OLD.map_id IS DISTINCT FROM NEW.map_id OR
+        OLD.schema_id IS DISTINCT FROM NEW.schema_id OR
+        OLD.symbol_id IS DISTINCT FROM NEW.symbol_id OR
+        OLD.deleted_at IS DISTINCT FROM NEW.deleted_at OR
+        OLD.data IS DISTINCT FROM NEW.data
+    )
+    EXECUTE FUNCTION app_features_usage_update();
+"""
+
+DROP_USAGE_TRIGGER = """
+DROP TRIGGER app_features_usage_update ON app_features;
+DROP TRIGGER app_features_usage_insert_delete ON app_features;
+DROP FUNCTION app_features_usage_update();
+DROP FUNCTION app_featureschemausage_apply(app_features, integer);
+"""
+
+BACKFILL_USAGE = """
+INSERT INTO app_featureschemausage (schema_id, map_id, kind, ref_id, count)
+SELECT f.schema_id, f.map_id, usage.kind, usage.ref_id, COUNT(*)
+FROM app_features AS f
+CROSS JOIN LATERAL (
+    SELECT 'schema' AS kind, 0 AS ref_id
+    UNION ALL
+    SELECT 'symbol', f.symbol_id WHERE f.symbol_id IS NOT NULL
+    UNION ALL
+    SELECT DISTINCT 'field', (item ->> 'schema_field_id')::integer FROM jsonb_array_elements(CASE WHEN jsonb_typeof(f.data) = 'array' THEN f.data ELSE '[]' END) AS item WHERE item ->> 'schema_field_id' ~ '^\\d+$'
+) AS usage
+WHERE f.deleted_at IS NULL AND f.schema_id IS NOT NULL
+GROUP BY f.schema_id, f.map_id, usage.kind, usage.ref_id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0059_features_search_text'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureSchemaUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.TextField(choices=[(mapa.app.enums.SchemaUsageKind['SCHEMA'], 'schema'), (mapa.app.enums.SchemaUsageKind['SYMBOL'], 'symbol'), (mapa.app.enums.SchemaUsageKind['FIELD'], 'field')])),
+                ('ref_id', models.IntegerField(default=0)),
+                ('count', models.IntegerField(default=0)),
+                ('map_id', models.ForeignKey(db_column='map_id', on_delete=django.db.models.deletion.CASCADE, to='app.maps')),
+                ('schema_id', models.ForeignKey(db_column='schema_id', on_delete=django.db.models.deletion.CASCADE, to='app.featureschemas')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('schema_id', 'kind', 'ref_id', 'map_id'), name='featureschemausage_unique')],
+            },
+        ),
+        migrations.RunSQL(CREATE_USAGE_TRIGGER, reverse_sql=DROP_USAGE_TRIGGER),
+        migrations.RunSQL(BACKFILL_USAGE, reverse_sql=migrations.RunSQL.noop),
+    ]
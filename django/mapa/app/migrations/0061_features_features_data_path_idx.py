@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:30
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0060_featureschemausage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='features',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['data'], name='features_data_path_idx', opclasses=['jsonb_path_ops']),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0061_features_features_data_path_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='featureschemas',
+            index=models.Index(condition=models.Q(('deleted_at', None)), fields=['owner_id', 'name'], name='featureschemas_live_owner_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='maps',
+            index=models.Index(condition=models.Q(('deleted_at', None)), fields=['owner_id', 'id'], name='maps_live_owner_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='features',
+            index=models.Index(condition=models.Q(('deleted_at', None)), fields=['map_id', 'id'], name='features_live_map_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='features',
+            index=models.Index(condition=models.Q(('deleted_at', None)), fields=['map_id', 'schema_id'], name='features_live_map_schema_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='features',
+            index=models.Index(condition=models.Q(('deleted_at', None)), fields=['schema_id', 'symbol_id'], name='features_live_schema_symbol_idx'),
+        ),
+    ]
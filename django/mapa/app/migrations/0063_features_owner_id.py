@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-18 13:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app', '0062_live_row_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='features',
+            name='owner_id',
+            field=models.ForeignKey(db_column='owner_id', null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='historicalfeatures',
+            name='owner_id',
+            field=models.ForeignKey(blank=True, db_column='owner_id', db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunSQL(
+            """
+                UPDATE app_features AS f SET owner_id = m.owner_id FROM app_maps AS m WHERE m.id = f.map_id;
+                UPDATE app_historicalfeatures AS hf SET owner_id = m.owner_id FROM app_maps AS m WHERE m.id = hf.map_id;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.7 on 2026-10-18 13:16
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app', '0063_features_owner_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='features',
+            name='owner_id',
+            field=models.ForeignKey(db_column='owner_id', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='features',
+            index=models.Index(condition=models.Q(('deleted_at', None)), fields=['owner_id', 'id'], name='features_live_owner_idx'),
+        ),
+    ]
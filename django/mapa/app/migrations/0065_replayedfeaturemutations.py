@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-18 14:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app', '0064_alter_features_owner_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReplayedFeatureMutations',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.TextField()),
+                ('op', models.TextField()),
+                ('feature_id', models.IntegerField(null=True)),
+                ('applied_date', models.DateTimeField(auto_now_add=True)),
+                ('owner_id', models.ForeignKey(db_column='owner_id', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('owner_id', 'key'), name='replayedfeaturemutations_unique')],
+            },
+        ),
+    ]
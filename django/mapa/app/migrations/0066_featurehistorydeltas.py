@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-18 15:10
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app', '0065_replayedfeaturemutations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureHistoryDeltas',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('feature_id', models.IntegerField()),
+                ('history_date', models.DateTimeField()),
+                ('changes', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('history_user', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['feature_id', 'history_date'], name='featurehistorydeltas_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.7 on 2026-10-18 17:00
+
+from django.db import migrations
+
+# Taking a feature's usage away only ever updates existing usage rows, and never inserts them.
+# When a map, schema or user is hard deleted Django deletes their usage rows before their
+# features (Features can't be fast deleted, as simple_history listens for their deletes), and
+# re-inserting usage rows (with a negative count) for the map or schema being deleted would
+# then fail its foreign key check when the transaction commits (see tests.CascadingDeleteTests).
+REPLACE_USAGE_FUNCTION = """
+CREATE OR REPLACE FUNCTION app_featureschemausage_apply(feature app_features, delta integer) RETURNS void AS $$
+BEGIN
+    IF feature.deleted_at IS NOT NULL OR feature.schema_id IS NULL THEN
+        RETURN;
+    END IF;
+
+    IF delta < 0 THEN
+        UPDATE app_featureschemausage AS u SET count = u.count + delta
+        FROM (
+            SELECT 'schema' AS kind, 0 AS ref_id
+            UNION ALL
+            SELECT 'symbol', feature.symbol_id WHERE feature.symbol_id IS NOT NULL
+            UNION ALL
+            SELECT DISTINCT 'field', (item ->> 'schema_field_id')::integer FROM jsonb_array_elements(CASE WHEN jsonb_typeof(feature.data) = 'array' THEN feature.data ELSE '[]' END) AS item WHERE item ->> 'schema_field_id' ~ '^\\d+$'
+        ) AS usage
+        WHERE u.schema_id = feature.schema_id AND u.map_id = feature.map_id AND u.kind = usage.kind AND u.ref_id = usage.ref_id;
+        RETURN;
+    END IF;
+
+    INSERT INTO app_featureschemausage (schema_id, map_id, kind, ref_id, count)
+    SELECT feature.schema_id, feature.map_id, usage.kind, usage.ref_id, delta
+    FROM (
+        SELECT 'schema' AS kind, 0 AS ref_id
+        UNION ALL
+        SELECT 'symbol', feature.symbol_id WHERE feature.symbol_id IS NOT NULL
+        UNION ALL
+        SELECT DISTINCT 'field', (item ->> 'schema_field_id')::integer FROM jsonb_array_elements(CASE WHEN jsonb_typeof(feature.data) = 'array' THEN feature.data ELSE '[]' END) AS item WHERE item ->> 'schema_field_id' ~ '^\\d+$'
+    ) AS usage
+    ON CONFLICT (schema_id, kind, ref_id, map_id) DO UPDATE SET count = app_featureschemausage.count + EXCLUDED.count;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+RESTORE_USAGE_FUNCTION = """
+CREATE OR REPLACE FUNCTION app_featureschemausage_apply(feature app_features, delta integer) RETURNS void AS $$
+BEGIN
+    IF feature.deleted_at IS NOT NULL OR feature.schema_id IS NULL THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO app_featureschemausage (schema_id, map_id, kind, ref_id, count)
+    SELECT feature.schema_id, feature.map_id, usage.kind, usage.ref_id, delta
+    FROM (
+        SELECT 'schema' AS kind, 0 AS ref_id
+        UNION ALL
+        SELECT 'symbol', feature.symbol_id WHERE feature.symbol_id IS NOT NULL
+        UNION ALL
+        SELECT DISTINCT 'field', (item ->> 'schema_field_id')::integer FROM jsonb_array_elements(CASE WHEN jsonb_typeof(feature.data) = 'array' THEN feature.data ELSE '[]' END) AS item WHERE item ->> 'schema_field_id' ~ '^\\d+$'
+    ) AS usage
+    ON CONFLICT (schema_id, kind, ref_id, map_id) DO UPDATE SET count = app_featureschemausage.count + EXCLUDED.count;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0066_featurehistorydeltas'),
+    ]
+
+    operations = [
+        migrations.RunSQL(REPLACE_USAGE_FUNCTION, reverse_sql=RESTORE_USAGE_FUNCTION),
+    ]
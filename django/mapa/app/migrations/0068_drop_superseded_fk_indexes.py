@@ -0,0 +1,36 @@
+# Generated by Django 5.2.7 on 2026-10-18 17:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app', '0067_featureschemausage_deletes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='features',
+            name='map_id',
+            field=models.ForeignKey(db_column='map_id', db_index=False, on_delete=django.db.models.deletion.CASCADE, to='app.maps'),
+        ),
+        migrations.AlterField(
+            model_name='features',
+            name='owner_id',
+            field=models.ForeignKey(db_column='owner_id', db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='featureschemas',
+            name='owner_id',
+            field=models.ForeignKey(db_column='owner_id', db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='maps',
+            name='owner_id',
+            field=models.ForeignKey(db_column='owner_id', db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
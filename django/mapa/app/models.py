@@ -1,10 +1,14 @@
-from mapa.app.enums import GeomType, ProfileSettings
+from mapa.app.enums import GeomType, ProfileSettings, SchemaUsageKind
+from mapa.app.history import DeferredHistoricalRecords, DeltaHistoricalRecords
 from model_utils import FieldTracker
-from simple_history.models import HistoricalRecords
 
 from django.contrib.auth.models import User
 from django.contrib.gis.db import models
+from django.contrib.postgres.indexes import GinIndex, GistIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import JSONField
+from django.db.models.functions import Cast
 
 # Create your models here.
 
@@ -19,7 +23,39 @@ def default_profile_settings():
     }
 
 
-class Profile(models.Model):
+class ChangedFieldsModelMixin:
+    """
+    Save only the fields that have changed since the instance was loaded
+    (according to its FieldTracker), so an UPDATE doesn't rewrite columns
+    (e.g. large JSON blobs) that haven't changed.
+
+    The model's FieldTracker needs to track every field (i.e. FieldTracker()),
+    as any it doesn't would never be saved. Fields the database maintains
+    itself (e.g. with triggers) go in database_maintained_fields instead.
+
+    Fields with auto_now are always saved. Inserts, and saves that pass
+    their own update_fields, are left alone.
+    """
+
+    database_maintained_fields = ()
+
+    def save(self, *args, **kwargs):
+        if self._state.adding is False and self.pk is not None and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = self.get_changed_fields()
+
+        super().save(*args, **kwargs)
+
+    def get_changed_fields(self):
+        untrackedFields = {field.attname for field in self._meta.concrete_fields} - set(self.tracker.fields)
+        if len(untrackedFields) > 0:
+            raise Exception(f"{type(self).__name__}'s FieldTracker doesn't track {', '.join(sorted(untrackedFields))}, so they'd never be saved")
+
+        changedFields = [attname for attname in self.tracker.changed() if attname != self._meta.pk.attname and attname not in self.database_maintained_fields]
+        autoNowFields = [field.attname for field in self._meta.concrete_fields if getattr(field, "auto_now", False) is True]
+        return changedFields + [attname for attname in autoNowFields if attname not in changedFields]
+
+
+class Profile(ChangedFieldsModelMixin, models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     profile_image_url = models.URLField(blank=False)
     is_approved = models.BooleanField(default=False)
@@ -53,39 +89,134 @@ class AllowedUsers(models.Model):
 class FeatureSchemas(models.Model):
     last_updated_date = models.DateTimeField(auto_now=True)
     name = models.TextField(unique=False)
-    owner_id = models.ForeignKey(User, on_delete=models.CASCADE, db_column="owner_id")
+    # Indexed by featureschemas_live_owner_idx instead
+    owner_id = models.ForeignKey(User, on_delete=models.CASCADE, db_column="owner_id", db_index=False)
     definition = JSONField(default=list, blank=True)
     # definition = JSONField(default=None, blank=True, validators=[JSONSchemaValidator(limit_value=noms_schema)])
     symbology = JSONField(default=dict, blank=True)
     default_symbology = JSONField(null=True)
     deleted_at = models.DateTimeField(null=True)
 
-    history = HistoricalRecords()
+    history = DeferredHistoricalRecords()
+
+    class Meta:
+        indexes = [
+            # Live-row indexes serve the hot queries checked by plans.check_query_plans
+            models.Index(fields=["owner_id", "name"], name="featureschemas_live_owner_idx", condition=models.Q(deleted_at=None)),
+        ]
 
 
 class Maps(models.Model):
     last_updated_date = models.DateTimeField(auto_now=True)
     name = models.TextField(unique=False)
-    owner_id = models.ForeignKey(User, on_delete=models.CASCADE, db_column="owner_id")
+    # Indexed by maps_live_owner_idx instead
+    owner_id = models.ForeignKey(User, on_delete=models.CASCADE, db_column="owner_id", db_index=False)
     default_symbology = JSONField(null=True)
     hero_icon = JSONField(null=True)
     deleted_at = models.DateTimeField(null=True)
     available_schema_ids = JSONField(default=list, blank=True)
     last_used_schema_id = models.ForeignKey(FeatureSchemas, null=True, on_delete=models.CASCADE, db_column="last_used_schema_id")
+    # Bumped whenever any of the map's features change (see sync.bump_features_version)
+    features_version = models.IntegerField(default=0)
+
+    history = DeferredHistoricalRecords(excluded_fields=["features_version"])
 
-    history = HistoricalRecords()
+    class Meta:
+        indexes = [
+            models.Index(fields=["owner_id", "id"], name="maps_live_owner_idx", condition=models.Q(deleted_at=None)),
+        ]
 
 
-class Features(models.Model):
+class Features(ChangedFieldsModelMixin, models.Model):
     creation_date = models.DateTimeField(auto_now_add=True)
     last_updated_date = models.DateTimeField(auto_now=True)
     geom = models.PointField(geography=True)
     geom_type = models.TextField(choices=[(tag, tag.value) for tag in GeomType])
-    map_id = models.ForeignKey(Maps, on_delete=models.CASCADE, db_column="map_id")
+    # Indexed by features_map_updated_idx (which also covers deleted features) and features_live_map_idx instead
+    map_id = models.ForeignKey(Maps, on_delete=models.CASCADE, db_column="map_id", db_index=False)
+    # Always the owner of the feature's map, so ownership checks don't need to join to Maps.
+    # Indexed by features_live_owner_idx instead.
+    owner_id = models.ForeignKey(User, on_delete=models.CASCADE, db_column="owner_id", db_index=False)
     schema_id = models.ForeignKey(FeatureSchemas, on_delete=models.CASCADE, blank=True, null=True, db_column="schema_id")
     symbol_id = models.IntegerField(blank=True, null=True)
     data = JSONField(default=list, blank=True)
     deleted_at = models.DateTimeField(null=True)
     import_job = models.TextField(blank=True, default="")
+    # Maintained by a database trigger from the text in `data` and the feature's symbol name (see search.py)
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Maintained by the same trigger as search_vector, for fuzzy (trigram) searches
+    search_text = models.TextField(null=True, editable=False)
 
-    history = HistoricalRecords()
+    history = DeltaHistoricalRecords(excluded_fields=["search_vector", "search_text"])
+    tracker = FieldTracker()
+    # Only ever written by the search trigger
+    database_maintained_fields = ("search_vector", "search_text")
+
+    class Meta:
+        indexes = [
+            # Serves delta syncs (and their tombstones) for a map
+            models.Index(fields=["map_id", "last_updated_date"], name="features_map_updated_idx"),
+            # Serves bounding box queries (see spatial.as_geometry), which want planar rather than geography semantics
+            GistIndex(Cast("geom", models.PointField(srid=4326)), name="features_geom_geometry_idx"),
+            GinIndex(fields=["search_vector"], name="features_search_vector_idx"),
+            GinIndex(fields=["search_text"], name="features_search_text_trgm_idx", opclasses=["gin_trgm_ops"]),
+            # Serves containment queries on data (see search.filter_by_field)
+            GinIndex(fields=["data"], name="features_data_path_idx", opclasses=["jsonb_path_ops"]),
+            models.Index(fields=["map_id", "id"], name="features_live_map_idx", condition=models.Q(deleted_at=None)),
+            models.Index(fields=["map_id", "schema_id"], name="features_live_map_schema_idx", condition=models.Q(deleted_at=None)),
+            models.Index(fields=["schema_id", "symbol_id"], name="features_live_schema_symbol_idx", condition=models.Q(deleted_at=None)),
+            models.Index(fields=["owner_id", "id"], name="features_live_owner_idx", condition=models.Q(deleted_at=None)),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Features are always owned by whoever owns their map
+        if self.owner_id_id is None or self.tracker.has_changed("map_id_id") is True:
+            self.owner_id_id = self.map_id.owner_id_id
+
+        super().save(*args, **kwargs)
+
+
+class FeatureHistoryDeltas(models.Model):
+    "Feature changes stored as deltas from the feature's previous state, rather than as full history rows (see history.DeltaHistoricalRecords)"
+
+    feature_id = models.IntegerField()
+    history_date = models.DateTimeField()
+    history_user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, db_constraint=False, related_name="+")
+    changes = JSONField(encoder=DjangoJSONEncoder)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["feature_id", "history_date"], name="featurehistorydeltas_idx"),
+        ]
+
+
+class ReplayedFeatureMutations(models.Model):
+    "The offline mutations we've already applied for each user, so replaying them again is harmless."
+
+    owner_id = models.ForeignKey(User, on_delete=models.CASCADE, db_column="owner_id")
+    # Generated by the client when it queued the mutation
+    key = models.TextField()
+    op = models.TextField()
+    feature_id = models.IntegerField(null=True)
+    applied_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["owner_id", "key"], name="replayedfeaturemutations_unique"),
+        ]
+
+
+class FeatureSchemaUsage(models.Model):
+    "How many live features on each map use a schema, and each of its symbols and fields. Maintained by database triggers on Features."
+
+    schema_id = models.ForeignKey(FeatureSchemas, on_delete=models.CASCADE, db_column="schema_id")
+    map_id = models.ForeignKey(Maps, on_delete=models.CASCADE, db_column="map_id")
+    kind = models.TextField(choices=[(tag, tag.value) for tag in SchemaUsageKind])
+    # The symbol or field id, or 0 for the schema itself
+    ref_id = models.IntegerField(default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["schema_id", "kind", "ref_id", "map_id"], name="featureschemausage_unique"),
+        ]
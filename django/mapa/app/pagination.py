@@ -0,0 +1,28 @@
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Keyset (cursor) pagination, so that fetching a page costs the same however
+    deep into the results the client is.
+    """
+    page_size = 1000
+    page_size_query_param = "page_size"
+    max_page_size = 10000
+
+
+class FeaturesPagination(KeysetPagination):
+    """
+    Opt-in keyset pagination for features, so existing clients still get every
+    feature in one go unless they ask for a ?page_size (or follow a ?cursor).
+    """
+    ordering = "-id"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.page_size_query_param not in request.query_params and self.cursor_query_param not in request.query_params:
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+
+class HistoryPagination(KeysetPagination):
+    ordering = "-history_date"
@@ -0,0 +1,386 @@
+import json
+import sys
+from array import array
+
+from mapa.app.exceptions import BadRequest
+from mapa.app.models import Features
+from mapa.app.serializers import FeatureSerializer
+from rest_framework.renderers import JSONRenderer
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.core.cache import caches
+from django.db import connection
+from django.db.models import BigIntegerField, FloatField, Func
+
+# In the same order as FeatureSerializer, so that both produce identical payloads
+FEATURE_FIELDS = FeatureSerializer.Meta.fields
+
+
+class GeomX(Func):
+    function = "ST_X"
+    template = "%(function)s(%(expressions)s::geometry)"
+    output_field = FloatField()
+
+
+class GeomY(GeomX):
+    function = "ST_Y"
+
+
+class EpochMicroseconds(Func):
+    template = "(EXTRACT(EPOCH FROM %(expressions)s) * 1000000)::bigint"
+    output_field = BigIntegerField()
+
+
+def format_coordinate(value):
+    """
+    Round a coordinate the way FeatureSerializer's GeometryField ends up doing.
+
+    GeometryField builds its GeoJSON via GDAL, which writes coordinates to 15
+    decimal places and then trims anything that looks like binary roundoff
+    (trailing 00000x or 99999x runs). This is a port of that logic (GDAL's
+    OGRFormatDouble and intelliround) so coordinates fetched straight from SQL
+    come out identical to the ones the serializer would have produced.
+
+    GDAL's output can change between versions, so check_feature_payloads()
+    needs to be run (via the "check_payloads" management event) after GDAL
+    is upgraded.
+    """
+    s = "%.15f" % value
+    length = len(s)
+
+    dotPos = s.index(".")
+    countBeforeDot = dotPos - 1
+    if s[0] == "-":
+        countBeforeDot -= 1
+
+    def roundup(s):
+        negative = s[0] == "-"
+        digits = list(s[1:] if negative is True else s)
+
+        for pos in range(len(digits) - 1, -1, -1):
+            if digits[pos] == ".":
+                continue
+            if digits[pos] != "9":
+                digits[pos] = str(int(digits[pos]) + 1)
+                break
+            digits[pos] = "0"
+            if pos == 0:
+                digits.insert(0, "1")
+
+        return ("-" if negative is True else "") + "".join(digits)
+
+    def run_of(char, start, end):
+        return all(s[length - i] == char for i in range(start, end + 1))
+
+    def looks_like_roundoff(char):
+        return dotPos < length - (8 if char == "0" else 9) and \
+            (countBeforeDot >= 4 or s[length - 3] == char) and \
+            (countBeforeDot >= 5 or s[length - 4] == char) and \
+            (countBeforeDot >= 6 or s[length - 5] == char) and \
+            (countBeforeDot >= 7 or s[length - 6] == char) and \
+            (countBeforeDot >= 8 or s[length - 7] == char) and \
+            s[length - 8] == char and s[length - 9] == char
+
+    if length > 10:
+        if run_of("0", 2, 6) is True:
+            s = s[:-1]
+        elif looks_like_roundoff("0") is True:
+            s = s[:-8]
+        elif run_of("9", 2, 6) is True:
+            s = roundup(s[:-6])
+        elif looks_like_roundoff("9") is True:
+            s = roundup(s[:-9])
+
+    return float(s)
+
+
+# Coordinates that exercise each branch of format_coordinate: trailing 000000 and
+# 999999 runs (both sides of the dot), negatives, and 5+ digits before the dot
+PAYLOAD_CHECK_COORDINATES = [
+    0.0,
+    1.0,
+    -1.0,
+    0.1,
+    -0.1,
+    0.3,
+    115.857048,
+    -31.953512,
+    115.85704799999999,
+    -31.953512000000004,
+    1.0000000000001,
+    -1.9999999999999,
+    1.00000001,
+    -1.99999999,
+    179.999999999999,
+    -89.999999999999,
+    12345.678901234567,
+    -12345.678900000001,
+    99999.99999999999,
+    -123456.789,
+    1234567.0000000002,
+    -98765432.1,
+    1e-10,
+    -1e-10,
+]
+
+
+def check_feature_payloads(queryset=None, coordinates=PAYLOAD_CHECK_COORDINATES):
+    """
+    Check that the fast read path (format_coordinate and serialize_features)
+    produces exactly what FeatureSerializer does under the GDAL we're running:
+
+    1. Each of `coordinates` is formatted the same as GDAL's GeoJSON writer.
+    2. The payloads for `queryset` (by default a sample of real features) are byte-identical.
+
+    Returns a list of the mismatches found, which is empty if all is well.
+    """
+    mismatches = []
+
+    for value in coordinates:
+        expected = json.loads(Point(value, value).geojson)["coordinates"][0]
+        if format_coordinate(value) != expected:
+            mismatches.append(f"Coordinate {value!r}: expected {expected!r}, got {format_coordinate(value)!r}")
+
+    if queryset is None:
+        queryset = Features.objects.order_by("id")[:settings.FEATURES_PAYLOAD_CHECK_SAMPLE_SIZE]
+
+    renderer = JSONRenderer()
+    expectedFeatures = {feature["id"]: renderer.render(feature) for feature in FeatureSerializer(queryset, many=True).data}
+    for feature in serialize_features(queryset):
+        if renderer.render(feature) != expectedFeatures[feature["id"]]:
+            mismatches.append(f"Feature {feature['id']}: expected {expectedFeatures[feature['id']]!r}, got {renderer.render(feature)!r}")
+
+    return mismatches
+
+
+def parse_fields(value):
+    """
+    Parse a comma separated list of the feature fields a client wants back
+    (e.g. "id,geom,symbol_id,schema_id" to draw a map without fetching `data`).
+    """
+    fields = value.split(",")
+
+    unknown = [field for field in fields if field not in FEATURE_FIELDS]
+    if len(unknown) > 0:
+        raise BadRequest(f"Unknown fields '{','.join(unknown)}'")
+
+    # Features are always identified by their id, and fields always come back in the usual order
+    return tuple(field for field in FEATURE_FIELDS if field in fields or field == "id")
+
+
+def get_feature_rows(queryset, fields=FEATURE_FIELDS):
+    """
+    Fetch the columns needed to build feature payloads as plain dicts, with the
+    coordinates and creation timestamp pulled out in SQL, so that no model
+    instances or geometry objects are ever created.
+
+    Only the columns needed for `fields` are selected.
+    """
+    columns = [field for field in fields if field not in ("geom", "creation_date")]
+
+    expressions = {}
+    if "geom" in fields:
+        expressions.update(lon=GeomX("geom"), lat=GeomY("geom"))
+    if "creation_date" in fields:
+        expressions.update(creation_date_us=EpochMicroseconds("creation_date"))
+
+    return queryset.values(*columns, **expressions)
+
+
+def to_epoch_milliseconds(microseconds):
+    # Same arithmetic as TimestampReadOnlyField (via datetime.timestamp()) to keep the rounding identical
+    return round(microseconds / 10**6 * 1000) if microseconds is not None else None
+
+
+def feature_row_to_dict(row, fields=FEATURE_FIELDS):
+    """
+    Turn a row from get_feature_rows() into exactly what FeatureSerializer would return.
+    """
+    feature = {}
+
+    for field in fields:
+        if field == "geom":
+            feature["geom"] = {"type": "Point", "coordinates": [format_coordinate(row["lon"]), format_coordinate(row["lat"])]}
+        elif field == "creation_date":
+            feature["creation_date"] = to_epoch_milliseconds(row["creation_date_us"])
+        else:
+            feature[field] = row[field]
+
+    return feature
+
+
+def serialize_features(queryset, fields=FEATURE_FIELDS):
+    """
+    A fast, model-free equivalent of FeatureSerializer(queryset, many=True).data
+    """
+    return [feature_row_to_dict(row, fields) for row in get_feature_rows(queryset, fields)]
+
+
+def encode_columnar(rows, fields=FEATURE_FIELDS):
+    """
+    Encode rows from get_feature_rows() in our compact columnar format, which
+    avoids repeating every key for every feature and lets clients read columns
+    straight into typed arrays.
+
+    Layout (all numbers little-endian):
+
+        "MAPA"             4 bytes
+        header length      uint32
+        header             UTF-8 JSON, padded with spaces to an 8 byte boundary
+        columns            each starting on an 8 byte boundary, at the offsets
+                           (relative to the end of the header) given in the header
+
+    Columns:
+
+        id                 int32
+        coordinates        float64, interleaved lon/lat pairs
+        creation_date      float64, milliseconds since the epoch (NaN if unknown)
+        geom_type,
+        map_id,
+        schema_id,
+        symbol_id          uint8/16/32 indexes into the header's dictionaries of
+                           the distinct values of each
+        data               a UTF-8 JSON array of each feature's data
+
+    Only the columns for `fields` are included (with geom as coordinates).
+    """
+    ids = array("i")
+    coordinates = array("d")
+    creationDates = array("d")
+    dictionaries = {name: {} for name in ("geom_type", "map_id", "schema_id", "symbol_id") if name in fields}
+    indexes = {name: [] for name in dictionaries}
+    data = []
+
+    for row in rows:
+        ids.append(row["id"])
+        if "geom" in fields:
+            coordinates.extend((row["lon"], row["lat"]))
+        if "creation_date" in fields:
+            creationDates.append(to_epoch_milliseconds(row["creation_date_us"]) if row["creation_date_us"] is not None else float("nan"))
+        for name, dictionary in dictionaries.items():
+            indexes[name].append(dictionary.setdefault(row[name], len(dictionary)))
+        if "data" in fields:
+            data.append(row["data"])
+
+    columns = [("id", "int32", ids)]
+    if "geom" in fields:
+        columns.append(("coordinates", "float64", coordinates))
+    if "creation_date" in fields:
+        columns.append(("creation_date", "float64", creationDates))
+    for name, dictionary in dictionaries.items():
+        if len(dictionary) <= 2 ** 8:
+            columns.append((name, "uint8", array("B", indexes[name])))
+        elif len(dictionary) <= 2 ** 16:
+            columns.append((name, "uint16", array("H", indexes[name])))
+        else:
+            columns.append((name, "uint32", array("I", indexes[name])))
+    if "data" in fields:
+        columns.append(("data", "json", JSONRenderer().render(data)))
+
+    def pad(buffer, fill):
+        return buffer + fill * (-len(buffer) % 8)
+
+    body = b""
+    columnsHeader = []
+    for name, type, values in columns:
+        if isinstance(values, array) is True:
+            if sys.byteorder == "big":
+                values.byteswap()
+            values = values.tobytes()
+
+        columnsHeader.append({"name": name, "type": type, "offset": len(body), "length": len(values)})
+        body += pad(values, b"\0")
+
+    header = json.dumps({
+        "version": 1,
+        "count": len(ids),
+        "dictionaries": {name: list(dictionary) for name, dictionary in dictionaries.items()},
+        "columns": columnsHeader,
+    }, separators=(",", ":")).encode("utf-8")
+    # The 8 bytes of magic number and header length keep us aligned
+    header = pad(header, b" ")
+
+    return b"MAPA" + len(header).to_bytes(4, "little") + header + body
+
+
+def build_features_json(queryset, fields=FEATURE_FIELDS):
+    """
+    Have PostgreSQL build the entire JSON payload for the features in `queryset`
+    in a single query, so all we have to do is pass the bytes on to the client.
+
+    The result has the same shape as serialize_features(), but PostgreSQL does its
+    own number formatting and whitespace, so it is equivalent rather than identical.
+    """
+    expressions = {
+        "id": "f.id",
+        "geom": "ST_AsGeoJSON(f.geom, 15)::json",
+        "geom_type": "f.geom_type",
+        "map_id": "f.map_id",
+        "schema_id": "f.schema_id",
+        "symbol_id": "f.symbol_id",
+        "creation_date": "ROUND(EXTRACT(EPOCH FROM f.creation_date) * 1000)",
+        "data": "f.data",
+    }
+
+    idsSQL, params = queryset.values("id").query.sql_with_params()
+
+    with connection.cursor() as cursor:
+        # Cast to text so the driver hands us the JSON as-is, rather than parsing it
+        cursor.execute(f"""
+            SELECT COALESCE(json_agg(json_build_object({", ".join(f"'{field}', {expressions[field]}" for field in fields)})), '[]')::text
+            FROM {connection.ops.quote_name(Features._meta.db_table)} AS f
+            WHERE f.id IN ({idsSQL})
+        """, params)
+
+        return cursor.fetchone()[0]
+
+
+def get_or_build_payload(key, build, cacheAlias="features"):
+    """
+    Fetch a rendered payload from the cache, building and caching it if it's not there.
+
+    Keys embed map versions, so entries never need invalidating - stale ones just
+    stop being asked for and fall out of the cache as it evicts the least recently
+    used entries.
+    """
+    cache = caches[cacheAlias]
+
+    payload = cache.get(key)
+    if payload is None:
+        payload = build()
+        cache.set(key, payload)
+
+    return payload
+
+
+def stream_features(queryset, fields=FEATURE_FIELDS, chunk_size=None):
+    """
+    Yield the features in `queryset` as a JSON array, one chunk of rows at a time.
+
+    Rows are read through a server-side cursor, so only a single chunk of
+    features is ever held in memory regardless of how big the map is.
+    """
+    chunk_size = chunk_size or settings.FEATURES_STREAM_CHUNK_SIZE
+    renderer = JSONRenderer()
+
+    def render_chunk(chunk):
+        # Strip the enclosing brackets so chunks can be stitched into one array
+        return renderer.render(chunk)[1:-1]
+
+    yield b"["
+
+    chunk = []
+    separator = b""
+    for row in get_feature_rows(queryset, fields).iterator(chunk_size=chunk_size):
+        chunk.append(feature_row_to_dict(row, fields))
+
+        if len(chunk) == chunk_size:
+            yield separator + render_chunk(chunk)
+            separator = b","
+            chunk = []
+
+    if len(chunk) > 0:
+        yield separator + render_chunk(chunk)
+
+    yield b"]"
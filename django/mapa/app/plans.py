@@ -0,0 +1,43 @@
+from mapa.app.models import Features, FeatureSchemas, Maps
+
+from django.db import connection, transaction
+
+# The queries we run most, and the index each of them is meant to use.
+HOT_QUERIES = [
+    ("features_live_map_idx", lambda: Features.objects.filter(deleted_at=None, map_id=0).order_by("id")),
+    ("features_live_map_schema_idx", lambda: Features.objects.filter(map_id=0, deleted_at=None, schema_id__isnull=False).values_list("schema_id", flat=True).distinct()),
+    ("features_live_schema_symbol_idx", lambda: Features.objects.filter(schema_id=0, deleted_at=None, symbol_id=0)),
+    ("features_live_owner_idx", lambda: Features.objects.filter(deleted_at=None, owner_id=0).order_by("-id")),
+    ("maps_live_owner_idx", lambda: Maps.objects.filter(deleted_at=None, owner_id=0).order_by("id")),
+    ("featureschemas_live_owner_idx", lambda: FeatureSchemas.objects.filter(deleted_at=None, owner_id=0).order_by("name")),
+]
+
+
+def check_query_plans():
+    """
+    Check that each of our hot queries can use the index that's meant to serve it
+    (e.g. it will fail if the query changed shape and no longer matches the index's condition).
+
+    Sequential scans are turned off while we ask, as our development databases
+    are small enough that PostgreSQL would rightly ignore most indexes anyway.
+
+    Run via the "check_query_plans" management event against a real database,
+    and by tests.QueryPlanTests.
+
+    Returns a description of each query that doesn't use its index.
+    """
+    mismatches = []
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+        for indexName, build in HOT_QUERIES:
+            plan = build().explain()
+            if indexName not in plan:
+                mismatches.append(f"The query meant to use {indexName} doesn't. Its plan is:\n{plan}")
+
+        with connection.cursor() as cursor:
+            cursor.execute("RESET enable_seqscan")
+
+    return mismatches
@@ -0,0 +1,33 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+
+class BinaryRenderer(BaseRenderer):
+    """
+    Passes through payloads that the view has already encoded to bytes.
+    """
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None or isinstance(data, bytes) is True:
+            return data
+
+        # Errors still go back to the client as JSON
+        renderer_context["response"]["Content-Type"] = JSONRenderer.media_type
+        return JSONRenderer().render(data, accepted_media_type, renderer_context)
+
+
+class VectorTileRenderer(BinaryRenderer):
+    """
+    Mapbox Vector Tiles, as built for us by PostGIS.
+    """
+    media_type = "application/vnd.mapbox-vector-tile"
+    format = "mvt"
+
+
+class FeaturesColumnarRenderer(BinaryRenderer):
+    """
+    Features in our compact columnar format (see payloads.encode_columnar).
+    """
+    media_type = "application/vnd.mapa.features+columnar"
+    format = "columnar"
@@ -0,0 +1,107 @@
+import json
+import re
+
+from mapa.app.exceptions import BadRequest
+
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            TrigramWordSimilarity)
+from django.db import connection, transaction
+from django.db.models import F
+
+
+def filter_by_field(queryset, fieldId, value=None):
+    """
+    Limit a Features queryset to those with a value for a schema field (or a
+    particular value, if given).
+
+    This is a containment query, so it can use the GIN index on Features.data.
+    """
+    item = {"schema_field_id": fieldId}
+    if value is not None:
+        item["value"] = value
+
+    return queryset.filter(data__contains=[item])
+
+
+def parse_field_value(value):
+    """
+    Parse a field value from the query string, which may be JSON (e.g. 5 or true)
+    or just a bare string.
+    """
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_search_terms(value):
+    """
+    Split what the user typed into words, ignoring any punctuation.
+    """
+    terms = re.findall(r"\w+", value or "")
+    if len(terms) == 0:
+        raise BadRequest(f"Invalid search query '{value}'")
+
+    return terms
+
+
+def parse_search_query(value):
+    """
+    Turn what the user typed into a prefix-matching query, so results show up
+    while they're still typing (e.g. "feij" finds "Feijoa").
+    """
+    return SearchQuery(" & ".join(f"{term}:*" for term in parse_search_terms(value)), search_type="raw", config="simple")
+
+
+def search_features(queryset, value, limit):
+    """
+    Search a Features queryset by the text in their data and their symbol's name
+    (see the search_vector trigger), returning the ids of the best matches first.
+    """
+    query = parse_search_query(value)
+
+    return list(
+        queryset.filter(search_vector=query)
+        .annotate(rank=SearchRank(F("search_vector"), query))
+        .order_by("-rank", "id")
+        .values_list("id", flat=True)[:limit]
+    )
+
+
+def parse_similarity_threshold(value):
+    """
+    Parse how similar (0 - 1) a word has to be to count as a fuzzy match.
+    """
+    try:
+        threshold = float(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f"Invalid threshold '{value}'")
+
+    if (0 <= threshold <= 1) is False:
+        raise BadRequest(f"Invalid threshold '{value}'")
+
+    return threshold
+
+
+def fuzzy_search_features(queryset, value, limit, threshold):
+    """
+    Search a Features queryset for words that look like what the user typed,
+    so misspellings still match (e.g. "fejoa" finds "Feijoa"), returning the ids
+    of the most similar matches first.
+
+    The word similarity operator is what can use the trigram index on
+    search_text, and it takes its threshold from a setting rather than an
+    argument, so we set that for the duration of the query.
+    """
+    query = " ".join(parse_search_terms(value)).lower()
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)", [str(threshold)])
+
+        return list(
+            queryset.filter(search_text__trigram_word_similar=query)
+            .annotate(similarity=TrigramWordSimilarity(query, "search_text"))
+            .order_by("-similarity", "id")
+            .values_list("id", flat=True)[:limit]
+        )
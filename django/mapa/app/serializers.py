@@ -55,6 +55,15 @@ class MapSerializer(serializers.ModelSerializer):
     class Meta:
         model = Maps
         fields = ("id", "name", "owner_id", "default_symbology", "hero_icon", "available_schema_ids", "last_used_schema_id")
+        # Maps can't change hands, as their features are owned by whoever owns the map
+        read_only_fields = ("owner_id",)
+
+
+class HistoricalMapSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Maps.history.model
+        fields = ("history_id", "history_date", "history_type", "history_user") + MapSerializer.Meta.fields + ("deleted_at",)
+
 
 class FeatureSerializer(serializers.ModelSerializer):
     creation_date = TimestampReadOnlyField(required=False)
@@ -64,7 +73,21 @@ class FeatureSerializer(serializers.ModelSerializer):
         fields = ("id", "geom", "geom_type", "map_id", "schema_id", "symbol_id", "creation_date", "data")
 
 
+class HistoricalFeatureSerializer(serializers.ModelSerializer):
+    creation_date = TimestampReadOnlyField(required=False)
+
+    class Meta:
+        model = Features.history.model
+        fields = ("history_id", "history_date", "history_type", "history_user") + FeatureSerializer.Meta.fields + ("deleted_at",)
+
+
 class FeatureSchemaSerializer(serializers.ModelSerializer):
     class Meta:
         model = FeatureSchemas
         fields = ("id", "name", "owner_id", "definition", "symbology", "default_symbology")
+
+
+class HistoricalFeatureSchemaSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = FeatureSchemas.history.model
+        fields = ("history_id", "history_date", "history_type", "history_user") + FeatureSchemaSerializer.Meta.fields + ("deleted_at",)
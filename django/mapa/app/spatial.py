@@ -0,0 +1,173 @@
+import math
+
+from mapa.app.exceptions import BadRequest
+from mapa.app.models import Features
+from mapa.app.payloads import (FEATURE_FIELDS, feature_row_to_dict,
+                               get_feature_rows)
+
+from django.contrib.gis.db.models import PointField
+from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.measure import D
+from django.db import connection
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+
+# The width of the world in Web Mercator metres, and of a tile in pixels at zoom 0
+WEB_MERCATOR_WORLD_WIDTH = 2 * 20037508.342789244
+TILE_SIZE = 256
+
+
+def as_geometry(field="geom"):
+    """
+    Cast a geography column to geometry, matching the expression index on Features.geom.
+
+    Viewports are boxes in lon/lat, so we want planar comparisons against them
+    rather than geography's great circle edges.
+    """
+    return Cast(field, PointField(srid=4326))
+
+
+def parse_bbox(value):
+    """
+    Parse a "minx,miny,maxx,maxy" bounding box in WGS84.
+
+    minx may be greater than maxx for boxes that cross the antimeridian.
+    """
+    try:
+        minx, miny, maxx, maxy = [float(coord) for coord in value.split(",")]
+    except ValueError:
+        raise BadRequest(f"Invalid bbox '{value}'")
+
+    if all(math.isfinite(coord) for coord in (minx, miny, maxx, maxy)) is False:
+        raise BadRequest(f"Invalid bbox '{value}'")
+
+    if (-180 <= minx <= 180) is False or (-180 <= maxx <= 180) is False or (-90 <= miny <= maxy <= 90) is False:
+        raise BadRequest(f"Invalid bbox '{value}'")
+
+    return (minx, miny, maxx, maxy)
+
+
+def parse_point(lon, lat):
+    """
+    Parse a lon/lat pair in WGS84.
+    """
+    try:
+        lon, lat = float(lon), float(lat)
+    except (TypeError, ValueError):
+        raise BadRequest(f"Invalid point '{lon},{lat}'")
+
+    if (-180 <= lon <= 180) is False or (-90 <= lat <= 90) is False:
+        raise BadRequest(f"Invalid point '{lon},{lat}'")
+
+    return (lon, lat)
+
+
+def filter_by_bbox(queryset, bbox):
+    """
+    Limit a Features queryset to those inside a bounding box from parse_bbox().
+    """
+    minx, miny, maxx, maxy = bbox
+
+    def box(minx, maxx):
+        polygon = Polygon.from_bbox((minx, miny, maxx, maxy))
+        polygon.srid = 4326
+        return Q(geom_geometry__intersects=polygon)
+
+    queryset = queryset.annotate(geom_geometry=as_geometry())
+
+    if minx <= maxx:
+        return queryset.filter(box(minx, maxx))
+
+    # Split boxes that cross the antimeridian in two
+    return queryset.filter(box(minx, 180) | box(-180, maxx))
+
+
+def get_nearest_features(queryset, lon, lat, limit, maxDistance=None, fields=FEATURE_FIELDS):
+    """
+    Find the features in a queryset nearest to a point, closest first, along
+    with how far away they are (in metres).
+
+    Ordering by the KNN operator (<->) walks the spatial index on Features.geom
+    outwards from the point, so only the features we return are ever measured.
+    """
+    distance = RawSQL(
+        f"{connection.ops.quote_name(Features._meta.db_table)}.geom <-> ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography",
+        (lon, lat),
+        output_field=FloatField(),
+    )
+
+    if maxDistance is not None:
+        queryset = queryset.filter(geom__dwithin=(Point(lon, lat, srid=4326), D(m=maxDistance)))
+
+    rows = get_feature_rows(queryset, fields).annotate(distance=distance).order_by("distance")[:limit]
+
+    return [{**feature_row_to_dict(row, fields), "distance": row["distance"]} for row in rows]
+
+
+def build_vector_tile(mapId, z, x, y, extent=4096, buffer=64):
+    """
+    Build a Mapbox Vector Tile of a map's features, carrying their schema and symbol ids.
+
+    The geometry cast in the WHERE clause matches the expression index on
+    Features.geom, and the tile envelope is grown by the buffer so symbols
+    straddling tile edges are drawn on both sides.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            WITH bounds AS (
+                SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom
+            ),
+            tile AS (
+                SELECT
+                    f.id,
+                    f.schema_id,
+                    f.symbol_id,
+                    ST_AsMVTGeom(ST_Transform(f.geom::geometry(Point, 4326), 3857), bounds.geom, %(extent)s, %(buffer)s) AS geom
+                FROM {connection.ops.quote_name(Features._meta.db_table)} AS f, bounds
+                WHERE f.map_id = %(map_id)s
+                    AND f.deleted_at IS NULL
+                    AND f.geom::geometry(Point, 4326) && ST_Transform(ST_Expand(bounds.geom, (ST_XMax(bounds.geom) - ST_XMin(bounds.geom)) * %(buffer)s / %(extent)s), 4326)
+            )
+            SELECT ST_AsMVT(tile, 'features', %(extent)s, 'geom', 'id') FROM tile
+        """, {"map_id": mapId, "z": z, "x": x, "y": y, "extent": extent, "buffer": buffer})
+
+        tile = cursor.fetchone()[0]
+        return bytes(tile) if tile is not None else b""
+
+
+def build_clusters(mapId, zoom, cellSize=60):
+    """
+    Cluster a map's features on a grid of cellSize pixels at the given zoom level.
+
+    Each cluster is the centroid of its features, how many there are, and the
+    most common symbol (as a schema_id/symbol_id pair, as symbol ids are only
+    unique within a schema).
+    """
+    cellSizeMetres = WEB_MERCATOR_WORLD_WIDTH / (TILE_SIZE * 2 ** zoom) * cellSize
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT
+                ST_X(ST_Centroid(ST_Collect(geom))),
+                ST_Y(ST_Centroid(ST_Collect(geom))),
+                COUNT(*),
+                mode() WITHIN GROUP (ORDER BY ARRAY[schema_id, symbol_id])
+            FROM (
+                SELECT
+                    f.geom::geometry(Point, 4326) AS geom,
+                    f.schema_id,
+                    f.symbol_id,
+                    ST_Transform(f.geom::geometry(Point, 4326), 3857) AS projected
+                FROM {connection.ops.quote_name(Features._meta.db_table)} AS f
+                WHERE f.map_id = %(map_id)s AND f.deleted_at IS NULL
+            ) AS features
+            GROUP BY FLOOR(ST_X(projected) / %(cell_size)s), FLOOR(ST_Y(projected) / %(cell_size)s)
+        """, {"map_id": mapId, "cell_size": cellSizeMetres})
+
+        return [{
+            "geom": {"type": "Point", "coordinates": [lon, lat]},
+            "count": count,
+            "schema_id": dominantSymbol[0],
+            "symbol_id": dominantSymbol[1],
+        } for lon, lat, count, dominantSymbol in cursor.fetchall()]
@@ -0,0 +1,159 @@
+from datetime import datetime, timedelta
+from itertools import groupby
+
+import pytz
+from mapa.app.exceptions import BadRequest
+from mapa.app.models import Features, Maps
+from mapa.app.payloads import (FEATURE_FIELDS, feature_row_to_dict,
+                               get_feature_rows, get_or_build_payload,
+                               serialize_features)
+
+from django.conf import settings
+from django.db.models import Exists, F, Max, OuterRef
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def to_cursor(value):
+    """
+    Encode a timestamp as an opaque sync cursor (microseconds since the epoch).
+    """
+    return str((value - EPOCH) // timedelta(microseconds=1))
+
+
+def from_cursor(cursor):
+    """
+    Decode a sync cursor back into the timestamp it was made from.
+    """
+    try:
+        microseconds = int(cursor)
+    except (TypeError, ValueError):
+        raise BadRequest(f"Invalid cursor '{cursor}'")
+
+    if microseconds < 0:
+        raise BadRequest(f"Invalid cursor '{cursor}'")
+
+    try:
+        return EPOCH + timedelta(microseconds=microseconds)
+    except OverflowError:
+        raise BadRequest(f"Invalid cursor '{cursor}'")
+
+
+def get_features_delta(mapIds, since, fields=FEATURE_FIELDS):
+    """
+    Build the delta-sync payload for the given maps: every live feature created
+    or updated after `since`, plus the ids of any features soft-deleted (or moved
+    off of these maps) after it.
+
+    Soft-deleting a feature saves it, so `last_updated_date` covers deletions too.
+    Features that have moved to another map are found from their history (which
+    compaction always keeps a row of for each map a feature has been on).
+
+    The returned cursor is the newest `last_updated_date` we've accounted for, and
+    rows are bounded by it so that writes landing mid-request are picked up by the
+    next sync rather than skipped. `last_updated_date` is stamped before a change is
+    committed though, so a slow transaction can commit a change stamped before the
+    cursor. To catch those we always look back settings.FEATURES_SYNC_OVERLAP_SECONDS
+    before `since`, and clients treat the features (and deletions) they get back as
+    upserts, so being sent something twice is harmless.
+    """
+    after = since - timedelta(seconds=settings.FEATURES_SYNC_OVERLAP_SECONDS)
+    features = Features.objects.filter(map_id__in=mapIds)
+    # Features that have changed on the owner's other maps since, and that used to be on
+    # these maps (so may still be on the client). Narrowed down before we look at history,
+    # so this costs as much as the recent changes rather than as much as the history.
+    movedAway = Features.objects.filter(
+        owner_id__in=Maps.objects.filter(id__in=mapIds).values("owner_id"),
+        last_updated_date__gt=after,
+    ).exclude(map_id__in=mapIds).filter(
+        Exists(Features.history.filter(id=OuterRef("id"), map_id__in=mapIds))
+    )
+
+    latest = max([latest for latest in [
+        features.aggregate(latest=Max("last_updated_date"))["latest"],
+        movedAway.aggregate(latest=Max("last_updated_date"))["latest"],
+    ] if latest is not None], default=None)
+
+    if latest is None or latest <= after:
+        return {"cursor": to_cursor(since), "features": [], "deleted_ids": []}
+
+    changed = features.filter(last_updated_date__gt=after, last_updated_date__lte=latest)
+    deletedIds = list(changed.exclude(deleted_at=None).values_list("id", flat=True)) + list(movedAway.filter(last_updated_date__lte=latest).values_list("id", flat=True))
+
+    return {
+        # Never move the cursor backwards, even if the latest change we can see now is older
+        "cursor": to_cursor(max(latest, since)),
+        "features": serialize_features(changed.filter(deleted_at=None), fields),
+        # A client syncing from the beginning of time has nothing to delete
+        "deleted_ids": deletedIds if since > EPOCH else [],
+    }
+
+
+def bump_features_version(mapIds):
+    """
+    Record that the features on these maps have changed, which invalidates
+    any cached payloads (and ETags) for them.
+    """
+    Maps.objects.filter(id__in=mapIds).update(features_version=F("features_version") + 1)
+
+
+def get_features_etag(mapIds, variant):
+    """
+    Build the ETag for a features payload from the current version of each map
+    in it, plus whatever else changes the bytes we send back (e.g. how it's built).
+    """
+    versions = Maps.objects.filter(id__in=mapIds).order_by("id").values_list("id", "features_version")
+    return '"features-{}-{}"'.format(variant, "-".join(f"{id}.{version}" for id, version in versions))
+
+
+def is_not_modified(request, etag):
+    """
+    Whether the client already has the payload with this ETag, according to its If-None-Match.
+
+    nginx weakens our ETags (to W/"...") when it gzips a response, and clients send
+    them back like that, so they're compared weakly (as If-None-Match should be).
+    """
+    return any(tag == "*" or tag.removeprefix("W/") == etag.removeprefix("W/") for tag in parse_etags(request.headers.get("If-None-Match", "")))
+
+
+def get_features_response(request, etag, build, contentType="application/json", cacheAlias="features"):
+    """
+    Respond with the payload that has this ETag: a 304 if the client already has it,
+    or else the payload (from the cache, if it's been built before). Pass a
+    cacheAlias of None for payloads that aren't worth caching.
+
+    Responses are private to the user, so can't sit in a shared cache, but
+    browsers check back with us (using the ETag) every time.
+    """
+    if is_not_modified(request, etag) is True:
+        response = HttpResponseNotModified()
+    else:
+        payload = get_or_build_payload(etag, build, cacheAlias) if cacheAlias is not None else build()
+        response = HttpResponse(payload, content_type=contentType)
+
+    response["ETag"] = etag
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def get_features_by_map(mapIds, fields=FEATURE_FIELDS):
+    """
+    Load the live features of several maps in one query, grouped by map, with
+    each map's version and a cursor to delta-sync it from later on.
+    """
+    # Take the cursors first, so anything written while we're loading features is re-sent by the next sync rather than missed
+    cursors = {mapId: to_cursor(latest) for mapId, latest in Features.objects.filter(map_id__in=mapIds).values("map_id").annotate(latest=Max("last_updated_date")).values_list("map_id", "latest")}
+    versions = dict(Maps.objects.filter(id__in=mapIds).values_list("id", "features_version"))
+
+    # We always need map_id to group by, even if the client didn't ask for it
+    rows = get_feature_rows(Features.objects.filter(deleted_at=None, map_id__in=mapIds).order_by("map_id", "id"), fields if "map_id" in fields else fields + ("map_id",))
+    featuresByMap = {mapId: [feature_row_to_dict(row, fields) for row in mapRows] for mapId, mapRows in groupby(rows, key=lambda row: row["map_id"])}
+
+    return [{
+        "map_id": mapId,
+        "version": versions[mapId],
+        "cursor": cursors.get(mapId, to_cursor(EPOCH)),
+        "features": featuresByMap.get(mapId, []),
+    } for mapId in sorted(versions)]
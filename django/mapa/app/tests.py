@@ -0,0 +1,69 @@
+from mapa.app.enums import GeomType, SchemaUsageKind
+from mapa.app.models import Features, FeatureSchemas, FeatureSchemaUsage, Maps
+from mapa.app.plans import check_query_plans
+
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.test import TestCase
+
+
+class CascadingDeleteTests(TestCase):
+    "Hard deleting a map, schema or user has to get past the usage trigger's foreign keys."
+
+    def setUp(self):
+        self.user = User.objects.create(username="cascading_deletes")
+        self.schema = FeatureSchemas.objects.create(name="Schema", owner_id=self.user, definition=[{"id": 1}], symbology={"symbols": [{"id": 1}]})
+        self.map = Maps.objects.create(name="Map", owner_id=self.user)
+        Features.objects.create(geom=Point(115.86, -31.95), geom_type=GeomType.POINT, map_id=self.map, schema_id=self.schema, symbol_id=1, data=[{"schema_field_id": 1, "value": "Value"}])
+
+    def check_constraints(self):
+        # Raises an IntegrityError if a delete left anything pointing at a deleted row
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            cursor.execute("SET CONSTRAINTS ALL DEFERRED")
+
+    def test_delete_map(self):
+        self.map.delete()
+        self.check_constraints()
+        self.assertFalse(FeatureSchemaUsage.objects.filter(schema_id=self.schema).exists())
+
+    def test_delete_schema(self):
+        self.schema.delete()
+        self.check_constraints()
+        self.assertFalse(Features.objects.filter(map_id=self.map).exists())
+
+    def test_delete_user(self):
+        self.user.delete()
+        self.check_constraints()
+        self.assertFalse(Maps.objects.filter(id=self.map.id).exists())
+
+
+class SchemaUsageDataTests(TestCase):
+    "data isn't validated, so the usage trigger has to cope with whatever is saved in it."
+
+    def setUp(self):
+        self.user = User.objects.create(username="schema_usage_data")
+        self.schema = FeatureSchemas.objects.create(name="Schema", owner_id=self.user, definition=[{"id": 1}], symbology={"symbols": []})
+        self.map = Maps.objects.create(name="Map", owner_id=self.user)
+
+    def create_feature(self, data):
+        return Features.objects.create(geom=Point(115.86, -31.95), geom_type=GeomType.POINT, map_id=self.map, schema_id=self.schema, data=data)
+
+    def test_non_array_data(self):
+        feature = self.create_feature({"schema_field_id": 1})
+        feature.data = "Value"
+        feature.save()
+        feature.delete()
+
+        self.assertFalse(FeatureSchemaUsage.objects.filter(schema_id=self.schema, kind=SchemaUsageKind.FIELD).exists())
+
+    def test_non_integer_field_ids(self):
+        self.create_feature([{"schema_field_id": "one"}, {"schema_field_id": 1.5}, {"schema_field_id": 2}])
+
+        self.assertEqual(list(FeatureSchemaUsage.objects.filter(schema_id=self.schema, kind=SchemaUsageKind.FIELD).values_list("ref_id", flat=True)), [2])
+
+
+class QueryPlanTests(TestCase):
+    def test_hot_queries_use_their_indexes(self):
+        self.assertEqual(check_query_plans(), [])
@@ -4,7 +4,7 @@ from django.urls import include, re_path
 
 from .views import (CurrentUserView, FeatureSchemasViewSet, FeaturesViewSet,
                     LogoutUserView, ManagementEventsView, MapsViewSet,
-                    ProfileViewSet, UserViewSet, api_not_found)
+                    MapTilesView, ProfileViewSet, UserViewSet, api_not_found)
 
 router = routers.DefaultRouter()
 router.register(r'users', UserViewSet)
@@ -20,6 +20,7 @@ router.register(r'schemas', FeatureSchemasViewSet, 'FeatureSchemasViewSet')
 
 urlpatterns = [
     re_path(r'^0.1/', include(router.urls)),
+    re_path(r'^0.1/maps/(?P<pk>\d+)/tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$', MapTilesView.as_view(), name='api-map-tiles'),
     re_path(r'^0.1/management/events$', ManagementEventsView.as_view(), name='api-management-events'),
     re_path(r'^0.1/self$', CurrentUserView.as_view(), name='api-self'),
     re_path(r'^0.1/logout$', LogoutUserView.as_view(), name='api-logout'),
@@ -1,3 +1,4 @@
+import math
 import numbers
 import os
 from copy import deepcopy
@@ -6,28 +7,106 @@ from http.client import BAD_REQUEST
 
 import pytz
 from mapa.app.admin import is_admin
+from mapa.app.batch import apply_feature_operations, replay_feature_mutations
+from mapa.app.enums import SchemaUsageKind
 from mapa.app.envs import are_management_tasks_allowed
+from mapa.app.exceptions import BadRequest
 from mapa.app.export import orchestrate_google_drive_backup
-from mapa.app.models import Features, FeatureSchemas, Maps
+from mapa.app.history import compact_feature_history, get_feature_as_of
+from mapa.app.models import (Features, FeatureSchemas, FeatureSchemaUsage,
+                             Maps)
+from mapa.app.pagination import FeaturesPagination, HistoryPagination
+from mapa.app.payloads import (FEATURE_FIELDS, build_features_json,
+                               check_feature_payloads, encode_columnar,
+                               feature_row_to_dict, get_feature_rows,
+                               parse_fields, serialize_features,
+                               stream_features)
 from mapa.app.permissions import IsAuthenticatedAndOwnsEntityPermissions
+from mapa.app.plans import check_query_plans
+from mapa.app.renderers import FeaturesColumnarRenderer, VectorTileRenderer
+from mapa.app.search import (filter_by_field, fuzzy_search_features,
+                             parse_field_value, parse_similarity_threshold,
+                             search_features)
 from mapa.app.serializers import (FeatureSchemaSerializer, FeatureSerializer,
-                                  MapSerializer, UserSerializer)
+                                  HistoricalFeatureSchemaSerializer,
+                                  HistoricalFeatureSerializer,
+                                  HistoricalMapSerializer, MapSerializer,
+                                  UserSerializer)
+from mapa.app.spatial import (build_clusters, build_vector_tile,
+                              filter_by_bbox, get_nearest_features,
+                              parse_bbox, parse_point)
+from mapa.app.sync import (bump_features_version, from_cursor,
+                           get_features_by_map, get_features_delta,
+                           get_features_etag, get_features_response)
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
+from django.conf import settings
 from django.contrib.auth import logout
 from django.contrib.auth.models import User
-from django.db.models import Count
-from django.http import HttpResponseNotFound
+from django.http import (HttpResponse, HttpResponseNotFound,
+                         StreamingHttpResponse)
+from django.utils.decorators import method_decorator
+from django.views.decorators.vary import vary_on_headers
 
 
 def api_not_found(request):
     return HttpResponseNotFound()
 
 
+def get_active_map_ids(user):
+    """
+    Resolve the ids of the user's active map(s) from their profile settings.
+    """
+    # Note: This will probably eventually allow for a list of active_map_ids on the profile, not just one.
+    # Requires a lot of UI rework to support it though.
+    # e.g. Some uses of useGetFeaturesQuery will need to think about filtering the result by map and whatnot.
+    if user.profile.settings is not None and "last_map_id" in user.profile.settings and user.profile.settings["last_map_id"] is not None:
+        return list(Maps.objects.filter(deleted_at=None, owner_id=user.id, id=user.profile.settings["last_map_id"]).values_list("id", flat=True))
+    return []
+
+
+def parse_map_ids(user, value):
+    """
+    Parse a comma separated list of map ids, keeping only those the user owns.
+    """
+    try:
+        mapIds = [int(mapId) for mapId in value.split(",")]
+    except ValueError:
+        raise BadRequest(f"Invalid map ids '{value}'")
+
+    return list(Maps.objects.filter(deleted_at=None, owner_id=user.id, id__in=mapIds).values_list("id", flat=True))
+
+
+def get_schema_usage(schemaId, kind, refId=0):
+    """
+    How many live features use a schema (or one of its symbols or fields), in
+    total and on each map, from the counts the database keeps up to date for us.
+    """
+    countByMap = list(FeatureSchemaUsage.objects.filter(schema_id=schemaId, kind=kind, ref_id=refId, count__gt=0).order_by("map_id").values("map_id", "count"))
+    count = sum(usage["count"] for usage in countByMap)
+
+    return {
+        "deletable": count == 0,
+        "count": count,
+        "count_by_map": countByMap,
+    }
+
+
+def get_requested_fields(request):
+    """
+    The feature fields the client asked for with ?fields=, or all of them.
+    """
+    value = request.query_params.get("fields")
+    return parse_fields(value) if value is not None else FEATURE_FIELDS
+
+
 class ManagementEventsView(APIView):
     """
     API endpoint that allows management actions to be undertaken
@@ -43,6 +122,16 @@ class ManagementEventsView(APIView):
 
             if eventType == "backup_to_google_drive":
                 orchestrate_google_drive_backup()
+            elif eventType == "compact_history":
+                compact_feature_history()
+            elif eventType == "check_payloads":
+                mismatches = check_feature_payloads()
+                if len(mismatches) > 0:
+                    raise Exception("The fast read path no longer matches FeatureSerializer:\n" + "\n".join(mismatches))
+            elif eventType == "check_query_plans":
+                mismatches = check_query_plans()
+                if len(mismatches) > 0:
+                    raise Exception("Some hot queries no longer use their indexes:\n" + "\n".join(mismatches))
             elif eventType == "run_migrations":
                 from django.core.management import execute_from_command_line
                 execute_from_command_line(['manage.py', 'migrate'])
@@ -85,6 +174,47 @@ class LogoutUserView(APIView):
         })
 
 
+class HistoryMixin:
+    """
+    Adds a keyset paginated history/ endpoint to a viewset, listing the
+    simple_history records of the user's entities, newest first.
+
+    Set history_queryset (e.g. Maps.history.all()) and history_serializer_class,
+    as with DRF's queryset and serializer_class.
+    """
+    history_queryset = None
+    history_serializer_class = None
+
+    def get_history_queryset(self):
+        return self.history_queryset.filter(owner_id=self.request.user.id)
+
+    @action(detail=False, methods=["GET"], pagination_class=HistoryPagination)
+    def history(self, request, format=None):
+        page = self.paginate_queryset(self.get_history_queryset())
+        serializer = self.history_serializer_class(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+
+class MapTilesView(APIView):
+    """
+    API endpoint that serves a map's features as Mapbox Vector Tiles.
+    """
+    permission_classes = (IsAuthenticated,)
+    renderer_classes = (VectorTileRenderer,)
+
+    def get(self, request, pk, z, x, y):
+        pk, z, x, y = int(pk), int(z), int(x), int(y)
+        if z > 30 or x >= 2 ** z or y >= 2 ** z:
+            raise BadRequest(f"There's no tile {z}/{x}/{y}")
+
+        if Maps.objects.filter(deleted_at=None, owner_id=request.user.id, id=pk).exists() is False:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        # Tiles only change when the map's features do. There are too many of them to be worth caching.
+        etag = get_features_etag([pk], "tile")
+        return get_features_response(request, etag, lambda: build_vector_tile(pk, z, x, y), contentType=VectorTileRenderer.media_type, cacheAlias=None)
+
+
 class UserViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
@@ -115,12 +245,14 @@ class ProfileViewSet(viewsets.ViewSet):
         return Response({}, status=status.HTTP_400_BAD_REQUEST)
 
 
-class MapsViewSet(viewsets.ModelViewSet):
+class MapsViewSet(HistoryMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows maps to be viewed and edited.
     """
     queryset = Maps.objects.filter(deleted_at=None).order_by("id")
     serializer_class = MapSerializer
+    history_queryset = Maps.history.all()
+    history_serializer_class = HistoricalMapSerializer
     permission_classes = (IsAuthenticated,)
 
     def get_queryset(self, *args, **kwargs):
@@ -129,10 +261,9 @@ class MapsViewSet(viewsets.ModelViewSet):
         )
 
     def create(self, request, format=None):
-        request.data.update({"owner_id": request.user.id})
         serializer = MapSerializer(data=request.data)
         if serializer.is_valid() is True:
-            serializer.save()
+            serializer.save(owner_id=request.user)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         else:
             return Response({}, status=status.HTTP_400_BAD_REQUEST)
@@ -148,22 +279,158 @@ class MapsViewSet(viewsets.ModelViewSet):
 
         return super().update(request, pk, *args, **kwargs)
 
-    @action(detail=False, methods=["GET"], serializer_class=FeatureSerializer)
+    @action(detail=False, methods=["GET"], serializer_class=FeatureSerializer, renderer_classes=api_settings.DEFAULT_RENDERER_CLASSES + [FeaturesColumnarRenderer])
+    # JSON or columnar, depending on what the client accepts, so caches need to keep them apart
+    @method_decorator(vary_on_headers("Accept"))
     def features(self, request, format=None):
         """
         Retrieve a list of all of the features for the user's active map.
+
+        Pass ?since=<cursor> to only receive the features created or updated
+        since a previous sync, along with the ids of any that have been deleted
+        (or moved to another map). Syncs overlap a little, so the same change
+        may be sent more than once.
+        Use ?since=0 for the initial sync to get a cursor to start from.
+
+        Pass ?bbox=minx,miny,maxx,maxy to only receive the features inside the
+        current viewport.
+
+        Pass ?stream=true to have the features streamed back in chunks, which
+        keeps memory use flat no matter how many features the map has.
+
+        Send "Accept: application/vnd.mapa.features+columnar" (or pass
+        ?format=columnar) to receive the features in our compact columnar
+        format rather than as JSON.
+
+        Full responses carry an ETag based on the map's features_version, and
+        are cached server-side under it, so reloading an unchanged map is cheap
+        (and free if the client sends If-None-Match).
+
+        Pass ?map_ids=1,2,3 to load the features of several maps in one go.
+        They come back grouped by map, along with each map's version and a
+        cursor for delta-syncing it later. None of the other options apply.
+
+        Pass ?fields=id,geom,symbol_id,schema_id (or any other combination) to
+        only receive those fields of each feature. This works with all of the
+        options above, and only the columns needed are read from the database.
         """
-        # Note: This will probably eventually allow for a list of active_map_ids on the profile, not just one.
-        # Requires a lot of UI rework to support it though.
-        # e.g. Some uses of useGetFeaturesQuery will need to think about filtering the result by map and whatnot.
-        
-        if request.user.profile.settings is not None and "last_map_id" in request.user.profile.settings and request.user.profile.settings["last_map_id"] is not None:
-            mapIds = Maps.objects.filter(deleted_at=None, owner_id=request.user.id, id=request.user.profile.settings["last_map_id"]).values_list("id", flat=True)
+        fields = get_requested_fields(request)
+        # Different fields make for different payloads, so they need their own ETags
+        fieldsVariant = "" if fields == FEATURE_FIELDS else "-" + ".".join(fields)
+
+        if request.query_params.get("map_ids") is not None:
+            mapIds = parse_map_ids(request.user, request.query_params.get("map_ids"))
+
+            etag = get_features_etag(mapIds, "by-map" + fieldsVariant)
+            return get_features_response(request, etag, lambda: JSONRenderer().render(get_features_by_map(mapIds, fields)))
+
+        mapIds = get_active_map_ids(request.user)
+        bbox = request.query_params.get("bbox")
+        isColumnar = request.accepted_renderer.format == FeaturesColumnarRenderer.format
+
+        since = request.query_params.get("since")
+        if since is not None:
+            if bbox is not None:
+                raise BadRequest("Delta syncs can't be limited to a bbox")
+            return Response(get_features_delta(mapIds, from_cursor(since), fields))
+
+        features = Features.objects.filter(deleted_at=None, map_id__in=mapIds)
+        if bbox is not None:
+            features = filter_by_bbox(features, parse_bbox(bbox))
+
+        # Columnar payloads need every row in hand before they can be written out, so they can't be streamed
+        if request.query_params.get("stream") == "true" and isColumnar is False:
+            return StreamingHttpResponse(stream_features(features, fields), content_type="application/json")
+
+        contentType = request.accepted_renderer.media_type if isColumnar is True else "application/json"
+        if isColumnar is True:
+            variant = "columnar"
+            build = lambda: encode_columnar(get_feature_rows(features, fields), fields)
+        elif settings.FEATURES_PAYLOAD_BUILDER == "database":
+            variant = "database"
+            build = lambda: build_features_json(features, fields).encode("utf-8")
+        else:
+            variant = "python"
+            build = lambda: JSONRenderer().render(serialize_features(features, fields))
+
+        # Viewports are too varied to be worth caching
+        if bbox is not None:
+            return HttpResponse(build(), content_type=contentType)
+
+        # Most of the time the map hasn't changed since the client last loaded it,
+        # so check that before doing any of the work of building the payload.
+        etag = get_features_etag(mapIds, variant + fieldsVariant)
+        return get_features_response(request, etag, build, contentType=contentType)
+
+    @action(detail=True, methods=["GET"])
+    def clusters(self, request, pk=None, format=None):
+        """
+        Retrieve the map's features clustered for display at a given ?zoom=<level>.
+        """
+        zoom = request.query_params.get("zoom")
+        if zoom is None or zoom.isdigit() is False or int(zoom) > 24:
+            raise BadRequest(f"Invalid zoom level '{zoom}'")
+
+        map = self.get_object()
+
+        # Clusters only change when the map's features do
+        etag = get_features_etag([map.id], f"clusters-{zoom}")
+        return get_features_response(request, etag, lambda: JSONRenderer().render(build_clusters(map.id, int(zoom))), cacheAlias="clusters")
+
+    @action(detail=True, methods=["GET"], url_path="features/nearest")
+    def nearest(self, request, pk=None, format=None):
+        """
+        Retrieve the features on the map nearest to ?lon=&lat=, closest first,
+        each with its distance in metres.
+
+        Pass ?limit=<n> to control how many come back (20 by default), and
+        ?max_distance=<metres> to ignore anything further away than that.
+        ?fields= works as it does for the features endpoint.
+        """
+        lon, lat = parse_point(request.query_params.get("lon"), request.query_params.get("lat"))
+
+        limit = request.query_params.get("limit", "20")
+        if limit.isdigit() is False or (1 <= int(limit) <= settings.FEATURES_NEAREST_MAX_LIMIT) is False:
+            raise BadRequest(f"Invalid limit '{limit}'")
+
+        maxDistance = request.query_params.get("max_distance")
+        if maxDistance is not None:
+            try:
+                maxDistance = float(maxDistance)
+            except ValueError:
+                raise BadRequest(f"Invalid max_distance '{maxDistance}'")
+
+            if math.isfinite(maxDistance) is False or maxDistance <= 0:
+                raise BadRequest(f"Invalid max_distance '{maxDistance}'")
 
-            serializer = FeatureSerializer(Features.objects.filter(deleted_at=None, map_id__in=list(mapIds)), many=True)
-            return Response(serializer.data)
+        map = self.get_object()
+        features = Features.objects.filter(deleted_at=None, map_id=map.id)
 
-        return Response([])
+        return Response(get_nearest_features(features, lon, lat, int(limit), maxDistance, get_requested_fields(request)))
+
+    @action(detail=True, methods=["GET"], url_path="features/search")
+    def search(self, request, pk=None, format=None):
+        """
+        Search the features on the map for ?q=, returning the ids of those that
+        match, best matches first.
+
+        Pass ?limit=<n> to control how many come back (100 by default).
+
+        Pass ?fuzzy=true to also match misspelt words, and ?threshold=<0 - 1>
+        to control how similar they need to be (higher is stricter).
+        """
+        limit = request.query_params.get("limit", "100")
+        if limit.isdigit() is False or (1 <= int(limit) <= settings.FEATURES_SEARCH_MAX_LIMIT) is False:
+            raise BadRequest(f"Invalid limit '{limit}'")
+
+        map = self.get_object()
+        features = Features.objects.filter(deleted_at=None, map_id=map.id)
+
+        if request.query_params.get("fuzzy") == "true":
+            threshold = parse_similarity_threshold(request.query_params.get("threshold", settings.FEATURES_SEARCH_FUZZY_THRESHOLD))
+            return Response(fuzzy_search_features(features, request.query_params.get("q"), int(limit), threshold))
+
+        return Response(search_features(features, request.query_params.get("q"), int(limit)))
 
     @action(detail=False, methods=["GET"], serializer_class=FeatureSerializer)
     def copy(self, request, format=None):
@@ -208,15 +475,19 @@ class MapsViewSet(viewsets.ModelViewSet):
         map.last_used_schema_id = oldToNewSchemaMapping[list(oldToNewSchemaMapping.keys())[0]]
         map.save()
 
+        bump_features_version([map.id])
+
         return Response({}, status=status.HTTP_201_CREATED)
 
 
-class FeatureSchemasViewSet(viewsets.ModelViewSet):
+class FeatureSchemasViewSet(HistoryMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows feature schemas to be viewed and edited.
     """
     queryset = FeatureSchemas.objects.filter(deleted_at=None).order_by("name")
     serializer_class = FeatureSchemaSerializer
+    history_queryset = FeatureSchemas.history.all()
+    history_serializer_class = HistoricalFeatureSchemaSerializer
     permission_classes = (IsAuthenticated,)
 
     def get_queryset(self, *args, **kwargs):
@@ -239,15 +510,7 @@ class FeatureSchemasViewSet(viewsets.ModelViewSet):
         Checks if a schema is in use and can be deleted.
         """
         schema = self.get_object()
-        features = Features.objects.filter(schema_id=schema.id, deleted_at=None)
-        featureCount = features.count()
-
-        return Response({
-            "deletable": featureCount == 0,
-            "count": featureCount,
-            "count_by_map": features.values("map_id").annotate(count=Count("map_id")),
-
-        })
+        return Response(get_schema_usage(schema.id, SchemaUsageKind.SCHEMA))
 
     def destroy(self, request, pk=None, format=None, permission_classes=(IsAuthenticatedAndOwnsEntityPermissions,)):
         """
@@ -255,7 +518,7 @@ class FeatureSchemasViewSet(viewsets.ModelViewSet):
         """
         schema = self.get_object()
 
-        if Features.objects.filter(schema_id=schema.id, deleted_at=None).count() == 0:
+        if get_schema_usage(schema.id, SchemaUsageKind.SCHEMA)["deletable"] is True:
             # Update any maps that have pointers to the schema
             Maps.objects.filter(last_used_schema_id=schema.id).update(last_used_schema_id=None)
 
@@ -276,19 +539,11 @@ class FeatureSchemasViewSet(viewsets.ModelViewSet):
         Checks if a symbol on this schema is in use and can be deleted.
         """
         symbolID = request.query_params.get("symbolID")
-        if symbolID is None:
+        if symbolID is None or symbolID.isdigit() is False:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
         schema = self.get_object()
-        features = Features.objects.filter(schema_id=schema.id, deleted_at=None, symbol_id=symbolID)
-        featureCount = features.count()
-
-        return Response({
-            "deletable": featureCount == 0,
-            "count": featureCount,
-            "count_by_map": features.values("map_id").annotate(count=Count("map_id")),
-
-        })
+        return Response(get_schema_usage(schema.id, SchemaUsageKind.SYMBOL, int(symbolID)))
 
     @action(detail=True, methods=["GET"], permission_classes=(IsAuthenticatedAndOwnsEntityPermissions,))
     def can_delete_field(self, request, pk=None, format=None):
@@ -296,41 +551,148 @@ class FeatureSchemasViewSet(viewsets.ModelViewSet):
         Checks if a field on this schema is in use and can be deleted.
         """
         fieldID = request.query_params.get("fieldID")
-        if fieldID is None:
+        if fieldID is None or fieldID.isdigit() is False:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
         schema = self.get_object()
-        features = Features.objects.filter(schema_id=schema.id, deleted_at=None, data__contains=[{"schema_field_id": int(fieldID)}])
-        featureCount = features.count()
-
-        return Response({
-            "deletable": featureCount == 0,
-            "count": featureCount,
-            "count_by_map": features.values("map_id").annotate(count=Count("map_id")),
-        })
+        return Response(get_schema_usage(schema.id, SchemaUsageKind.FIELD, int(fieldID)))
 
 
-class FeaturesViewSet(viewsets.ModelViewSet):
+class FeaturesViewSet(HistoryMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows elections to be viewed and edited.
     """
     queryset = Features.objects.filter(deleted_at=None).order_by("-id")
     serializer_class = FeatureSerializer
+    history_queryset = Features.history.all()
+    history_serializer_class = HistoricalFeatureSerializer
+    pagination_class = FeaturesPagination
     permission_classes = (IsAuthenticated,)
 
     def get_queryset(self, *args, **kwargs):
         return super().get_queryset(*args, **kwargs).filter(
-            map_id__owner_id=self.request.user.id
+            owner_id=self.request.user.id
         )
 
+    @action(detail=False, methods=["GET"], pagination_class=HistoryPagination)
+    def history(self, request, format=None):
+        """
+        List the history of the user's features, newest first.
+
+        When settings.FEATURE_HISTORY_STORAGE is "delta" most changes aren't in
+        the history table, so rather than silently leaving them out this isn't
+        available. Use features/<id>/as_of/ instead.
+        """
+        if settings.FEATURE_HISTORY_STORAGE == "delta":
+            raise BadRequest("Feature history is stored as deltas, so can only be viewed one feature at a time (via as_of)")
+
+        return super().history(request, format)
+
+    def list(self, request, format=None):
+        """
+        List the user's features without going through FeatureSerializer, which is slow for large lists.
+
+        Pass ?bbox=minx,miny,maxx,maxy to only list the features inside it.
+
+        Pass ?page_size=<n> to page through the features (newest first), following
+        the "next" links in each response.
+
+        Pass ?fields=id,geom,... to only list those fields of each feature.
+
+        Pass ?field_id=<id> to only list the features with a value for that
+        schema field, and ?field_value=<value> to only list those with that value.
+        """
+        fields = get_requested_fields(request)
+        features = self.filter_queryset(self.get_queryset())
+
+        fieldId = request.query_params.get("field_id")
+        if fieldId is not None:
+            if fieldId.isdigit() is False:
+                raise BadRequest(f"Invalid field_id '{fieldId}'")
+
+            fieldValue = request.query_params.get("field_value")
+            features = filter_by_field(features, int(fieldId), parse_field_value(fieldValue) if fieldValue is not None else None)
+
+        bbox = request.query_params.get("bbox")
+        if bbox is not None:
+            features = filter_by_bbox(features, parse_bbox(bbox))
+
+        page = self.paginate_queryset(get_feature_rows(features, fields))
+        if page is not None:
+            return self.get_paginated_response([feature_row_to_dict(row, fields) for row in page])
+
+        return Response(serialize_features(features, fields))
+
+    @action(detail=False, methods=["POST"])
+    def batch(self, request, format=None):
+        """
+        Create, update and delete many features in one go (see batch.apply_feature_operations).
+
+        Returns the created and updated features, the ids of those deleted,
+        and the id of the feature each operation applied to.
+        """
+        return Response(apply_feature_operations(request.user, request.data))
+
+    @action(detail=False, methods=["POST"])
+    def replay(self, request, format=None):
+        """
+        Replay the mutations a client queued up while it was offline (see batch.replay_feature_mutations).
+
+        Safe to retry: mutations that have already been applied are skipped.
+        Mutations that can't be applied are returned as conflicts, keyed by
+        mutation, and don't stop the rest from being applied.
+        """
+        return Response(replay_feature_mutations(request.user, request.data))
+
+    @action(detail=True, methods=["GET"])
+    def as_of(self, request, pk=None, format=None):
+        """
+        Get this feature as it was at ?timestamp=<milliseconds since the epoch>.
+
+        Deleted features are included, so long as they existed at the time.
+        """
+        timestamp = request.query_params.get("timestamp", "")
+        try:
+            asOf = datetime.fromtimestamp(int(timestamp) / 1000, pytz.utc)
+        except (ValueError, OverflowError, OSError):
+            # Anything that isn't a number, or is beyond the range datetime (or the platform) can represent
+            raise BadRequest(f"Invalid timestamp '{timestamp}'")
+
+        # The feature may have been deleted since, so we can't use get_object()
+        if pk.isdecimal() is False or Features.objects.filter(id=pk, owner_id=request.user.id).exists() is False:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        feature = get_feature_as_of(int(pk), asOf)
+        if feature is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        return Response(FeatureSerializer(feature).data)
+
+    def perform_create(self, serializer):
+        if serializer.validated_data["map_id"].owner_id_id != self.request.user.id:
+            raise PermissionDenied()
+
+        feature = serializer.save()
+        bump_features_version([feature.map_id_id])
+
+    def perform_update(self, serializer):
+        if "map_id" in serializer.validated_data and serializer.validated_data["map_id"].owner_id_id != self.request.user.id:
+            raise PermissionDenied()
+
+        # Features can be moved between maps, in which case both maps have changed
+        previousMapId = serializer.instance.map_id_id
+        feature = serializer.save()
+        bump_features_version({previousMapId, feature.map_id_id})
+
     def destroy(self, request, pk=None, format=None):
         """
         Mark this feature as deleted.
         """
         feature = self.get_object()
-        if feature.map_id.owner_id.id != request.user.id:
+        if feature.owner_id_id != request.user.id:
             return Response({}, status.HTTP_401_UNAUTHORIZED)
 
         feature.deleted_at = datetime.now(pytz.utc)
         feature.save()
+        bump_features_version([feature.map_id_id])
         return Response(status=status.HTTP_204_NO_CONTENT)
@@ -20,6 +20,8 @@ from mapa.app.envs import is_running_in_aws_lambda
 from mapa.util import get_secret_from_ssm_or_local_env_var
 from sentry_sdk.integrations.django import DjangoIntegration
 
+from django.core.exceptions import ImproperlyConfigured
+
 logger = Logger()
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -130,6 +132,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'django.contrib.gis',
+    'django.contrib.postgres',
     'social_django',
     'mapa.app',
     'rest_framework',
@@ -149,6 +152,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'simple_history.middleware.HistoryRequestMiddleware',
+    'mapa.app.history.DeferredHistoryMiddleware',
 ]
 
 AUTHENTICATION_BACKENDS = (
@@ -291,3 +295,83 @@ if os.environ.get("ENVIRONMENT") == "PRODUCTION" or os.environ.get("ENVIRONMENT"
 
 
 # Project-specific settings
+
+# The number of features read per round trip (and written per chunk) when streaming features
+FEATURES_STREAM_CHUNK_SIZE = 2000
+
+# Where the maps/features/ payload is built: "python" (the default) or "database" to have PostgreSQL build it
+FEATURES_PAYLOAD_BUILDER = os.environ.get("FEATURES_PAYLOAD_BUILDER", "python")
+
+# Rendered maps/features/ payloads, keyed by map versions and evicted least recently used first.
+# Setting CULL_FREQUENCY to MAX_ENTRIES makes LocMemCache evict a single entry when it's full.
+FEATURES_CACHE_MAX_ENTRIES = int(os.environ.get("FEATURES_CACHE_MAX_ENTRIES", "20"))
+
+# Rendered maps/<id>/clusters/ payloads, which are small but one per map and zoom level
+CLUSTERS_CACHE_MAX_ENTRIES = int(os.environ.get("CLUSTERS_CACHE_MAX_ENTRIES", "500"))
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "features": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "features",
+        "TIMEOUT": None,
+        "OPTIONS": {
+            "MAX_ENTRIES": FEATURES_CACHE_MAX_ENTRIES,
+            "CULL_FREQUENCY": FEATURES_CACHE_MAX_ENTRIES,
+        },
+    },
+    # Kept apart from the features cache, so panning through zoom levels doesn't evict the (much larger) map payloads
+    "clusters": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "clusters",
+        "TIMEOUT": None,
+        "OPTIONS": {
+            "MAX_ENTRIES": CLUSTERS_CACHE_MAX_ENTRIES,
+            "CULL_FREQUENCY": CLUSTERS_CACHE_MAX_ENTRIES,
+        },
+    },
+}
+
+# The most features the "nearest to me" endpoint will return in one go
+FEATURES_NEAREST_MAX_LIMIT = 1000
+
+# The most feature ids the search endpoint will return in one go
+FEATURES_SEARCH_MAX_LIMIT = 1000
+
+# How closely (0 - 1) a word in a feature has to match for fuzzy searches, unless the client says otherwise
+FEATURES_SEARCH_FUZZY_THRESHOLD = 0.5
+
+# The most operations a single features/batch/ request can make
+FEATURES_BATCH_MAX_OPERATIONS = 1000
+
+# When history rows are written for changes made in requests: "immediate" (on each save, the default),
+# "deferred" (in bulk at the end of the request) or "background" (in bulk, by a thread). See mapa.app.history.
+HISTORY_WRITE_MODE = os.environ.get("HISTORY_WRITE_MODE", "immediate")
+
+# Lambda freezes the process as soon as a response is returned, so background threads may never get to write
+if HISTORY_WRITE_MODE == "background" and is_running_in_aws_lambda() is True:
+    raise ImproperlyConfigured("HISTORY_WRITE_MODE can't be \"background\" when running in AWS Lambda, use \"deferred\" instead")
+
+# If set, feature history older than this many days is compacted into one version per HISTORY_COMPACTION_PERIOD
+# (one of "hour", "day", "week" or "month"), and optionally removed entirely after HISTORY_RETENTION_DAYS
+# (the latest version of each feature is always kept). Both permanently delete history, so are off unless
+# they're set. See mapa.app.history.compact_feature_history.
+HISTORY_COMPACTION_AGE_DAYS = int(os.environ["HISTORY_COMPACTION_AGE_DAYS"]) if "HISTORY_COMPACTION_AGE_DAYS" in os.environ else None
+HISTORY_COMPACTION_PERIOD = os.environ.get("HISTORY_COMPACTION_PERIOD", "day")
+HISTORY_RETENTION_DAYS = int(os.environ["HISTORY_RETENTION_DAYS"]) if "HISTORY_RETENTION_DAYS" in os.environ else None
+
+# How feature history is stored: "full" (a copy of the row for every change, the default) or "delta"
+# (most changes as small deltas, with a full snapshot every FEATURE_HISTORY_SNAPSHOT_INTERVAL changes).
+# See mapa.app.history.DeltaHistoricalRecords.
+FEATURE_HISTORY_STORAGE = os.environ.get("FEATURE_HISTORY_STORAGE", "full")
+FEATURE_HISTORY_SNAPSHOT_INTERVAL = int(os.environ.get("FEATURE_HISTORY_SNAPSHOT_INTERVAL", "20"))
+
+# How far before the client's cursor delta syncs look for changes, to pick up any that were
+# committed after a sync but stamped before it (see mapa.app.sync.get_features_delta)
+FEATURES_SYNC_OVERLAP_SECONDS = int(os.environ.get("FEATURES_SYNC_OVERLAP_SECONDS", "300"))
+
+# How many features the "check_payloads" management event compares between the fast read path and
+# FeatureSerializer (see mapa.app.payloads.check_feature_payloads)
+FEATURES_PAYLOAD_CHECK_SAMPLE_SIZE = 1000